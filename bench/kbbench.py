@@ -0,0 +1,377 @@
+import sys, os, time, json, random, tempfile, shutil, subprocess, socket, platform, getopt, threading
+from bisect import bisect
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kbstorage import KBFile, KBStorage, KBCachedStorage, KBClient, to_bytes
+
+Usage = """
+python kbbench.py [options] [<suite> ...]
+python kbbench.py compare <old.json> <new.json>
+
+    suites: file, storage, cache, server (default: all)
+
+    options:
+        -o <file.json>              write results to the file, default: stdout
+        -n <count>[,<count>...]     number of blobs, default: 1000,10000
+        -s <dist>[,<dist>...]       blob size distributions: fixed, uniform, lognormal, default: all
+        -b <size>                   mean blob size in bytes, default: 1000
+        -c <capacity>               cache capacity, default: 1000
+        -z <exponent>               Zipf exponent for the cache workload, default: 1.1
+        -t <threads>                load generator threads, default: 8
+        -d <seconds>                load generator run time, default: 5
+        -r <seed>                   random seed, default: 0
+        -p <partitions>             use the partitioned storage layout
+"""
+
+def blob_sizes(dist, n, mean):
+    if dist == "fixed":
+        return [mean] * n
+    elif dist == "uniform":
+        return [random.randint(1, 2*mean) for _ in range(n)]
+    elif dist == "lognormal":
+        # median = mean/2, heavy tail
+        return [max(1, int(random.lognormvariate(0, 1.2) * mean / 2)) for _ in range(n)]
+    raise ValueError("Unknown size distribution: " + dist)
+
+def make_blobs(dist, n, mean):
+    pool = os.urandom(4*mean + 1024*1024)
+    out = []
+    for i, size in enumerate(blob_sizes(dist, n, mean)):
+        start = random.randint(0, max(0, len(pool) - size))
+        out.append(("key.%08d" % (i,), pool[start:start+size]))
+    return out
+
+def rate(count, dt):
+    return count/dt if dt > 0 else None
+
+class Timer(object):
+
+    def __enter__(self):
+        self.T0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *params):
+        self.Elapsed = time.perf_counter() - self.T0
+
+def throughput(count, nbytes, dt):
+    return {
+        "count":        count,
+        "seconds":      dt,
+        "ops_per_sec":  rate(count, dt),
+        "MB_per_sec":   rate(nbytes/1024/1024, dt)
+    }
+
+def bench_file(work_dir, counts, dists, mean):
+    results = []
+    for dist in dists:
+        for n in counts:
+            blobs = make_blobs(dist, n, mean)
+            nbytes = sum(len(b) for _, b in blobs)
+            path = os.path.join(work_dir, "bench.kbf")
+            f = KBFile.create(path)
+            with Timer() as t:
+                for k, b in blobs:
+                    f.add_blob(k, b)
+            insert = throughput(n, nbytes, t.Elapsed)
+
+            order = list(range(n))
+            random.shuffle(order)
+            with Timer() as t:
+                for i in order:
+                    f.get_blob(blobs[i][0])
+            get = throughput(n, nbytes, t.Elapsed)
+            f.close()
+
+            with Timer() as t:
+                f = KBFile.open(path)
+            open_time = t.Elapsed
+            with Timer() as t:
+                f.read_directory()
+            directory_time = t.Elapsed
+
+            # delete every other blob, then compact
+            deleted = [blobs[i][0] for i in order[:n//2]]
+            deleted_bytes = sum(f.blob_size(k) for k in deleted)
+            with Timer() as t:
+                for k in deleted:
+                    del f[k]
+            delete = throughput(len(deleted), deleted_bytes, t.Elapsed)
+            with Timer() as t:
+                f.compact()
+            compact = throughput(len(f.Directory), nbytes - deleted_bytes, t.Elapsed)
+            f.close()
+            os.remove(path)
+
+            results.append({
+                "blobs":            n,
+                "size_dist":        dist,
+                "total_bytes":      nbytes,
+                "insert":           insert,
+                "get":              get,
+                "delete":           delete,
+                "open_seconds":     open_time,
+                "read_directory_seconds":   directory_time,
+                "compact":          compact
+            })
+    return results
+
+def bench_storage(work_dir, counts, dists, mean, partitions=None):
+    results = []
+    for dist in dists:
+        for n in counts:
+            root = tempfile.mkdtemp(dir=work_dir)
+            blobs = make_blobs(dist, n, mean)
+            nbytes = sum(len(b) for _, b in blobs)
+            storage = KBStorage(root, partitions=partitions)
+            with Timer() as t:
+                for k, b in blobs:
+                    storage.add_blob(k, b)
+            insert = throughput(n, nbytes, t.Elapsed)
+
+            keys = [k for k, _ in blobs]
+            random.shuffle(keys)
+            with Timer() as t:
+                for k in keys:
+                    storage.get_blob(k)
+            get = throughput(n, nbytes, t.Elapsed)
+
+            with Timer() as t:
+                storage = KBStorage(root)
+            load_time = t.Elapsed
+
+            with Timer() as t:
+                storage.get_blob(keys[0])           # loads the partition if partitioned
+            first_get_time = t.Elapsed
+
+            deleted = keys[:n//2]
+            with Timer() as t:
+                for k in deleted:
+                    storage.delete_blob(k)
+            delete = throughput(len(deleted), 0, t.Elapsed)
+            shutil.rmtree(root)
+
+            results.append({
+                "blobs":            n,
+                "size_dist":        dist,
+                "total_bytes":      nbytes,
+                "files":            len(storage.Files),
+                "insert":           insert,
+                "get":              get,
+                "delete":           delete,
+                "load_files_seconds":   load_time,
+                "first_get_seconds":    first_get_time
+            })
+    return results
+
+def zipf_sampler(n, exponent):
+    cum = []
+    total = 0.0
+    for i in range(1, n+1):
+        total += 1.0/i**exponent
+        cum.append(total)
+    def sample():
+        return bisect(cum, random.random() * total)
+    return sample
+
+def bench_cache(work_dir, counts, mean, capacity, exponent):
+    results = []
+    for n in counts:
+        root = tempfile.mkdtemp(dir=work_dir)
+        blobs = make_blobs("fixed", n, mean)
+        storage = KBCachedStorage(root, cache_capacity=capacity)
+        for k, b in blobs:
+            storage.DataSource.add_blob(k, b)       # bypass the cache
+        keys = [k for k, _ in blobs]
+        random.shuffle(keys)                         # popularity does not follow the insertion order
+        sample = zipf_sampler(n, exponent)
+        requests = n * 5
+        hits = 0
+        with Timer() as t:
+            for _ in range(requests):
+                k = keys[sample()]
+                if to_bytes(k) in storage.Cache:
+                    hits += 1
+                storage[k]
+        results.append({
+            "blobs":        n,
+            "capacity":     capacity,
+            "zipf_exponent":    exponent,
+            "requests":     requests,
+            "hit_ratio":    hits/requests,
+            "get":          throughput(requests, requests*mean, t.Elapsed)
+        })
+        shutil.rmtree(root)
+    return results
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server(work_dir):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    port = free_port()
+    config = os.path.join(work_dir, "server.yaml")
+    with open(config, "w") as f:
+        f.write("storage: %s\nusers:\n  bench: bench\n" % (os.path.join(work_dir, "server_storage"),))
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    process = subprocess.Popen([sys.executable, "KBServer.py", "-c", config, "-p", str(port)],
+            cwd=os.path.join(root, "server"), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    t1 = time.time() + 30
+    while time.time() < t1:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, "http://127.0.0.1:%d" % (port,)
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+def load(url, nthreads, duration, op):
+    # runs op(client, i) in nthreads threads for duration seconds, returns (count, bytes, latencies)
+    stats = []
+    t_end = time.time() + duration
+    def worker(j):
+        client = KBClient(url, username="bench", password="bench")
+        count = nbytes = 0
+        latencies = []
+        i = j
+        while time.time() < t_end:
+            t0 = time.perf_counter()
+            nbytes += op(client, i)
+            latencies.append(time.perf_counter() - t0)
+            count += 1
+            i += nthreads
+        stats.append((count, nbytes, latencies))
+    threads = [threading.Thread(target=worker, args=(j,)) for j in range(nthreads)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    dt = time.perf_counter() - t0
+    count = sum(s[0] for s in stats)
+    nbytes = sum(s[1] for s in stats)
+    latencies = sorted(l for s in stats for l in s[2])
+    out = throughput(count, nbytes, dt)
+    out["threads"] = nthreads
+    if latencies:
+        out["latency_ms"] = {
+            "p50":  latencies[len(latencies)//2]*1000,
+            "p99":  latencies[min(len(latencies)-1, int(len(latencies)*0.99))]*1000,
+            "max":  latencies[-1]*1000
+        }
+    return out
+
+def bench_server(work_dir, n, mean, nthreads, duration):
+    process, url = start_server(work_dir)
+    try:
+        blobs = make_blobs("fixed", n, mean)
+        def put(client, i):
+            k, b = blobs[i % n]
+            client.put(k, b)
+            return len(b)
+        def get(client, i):
+            return len(client.get(blobs[random.randrange(n)][0], compress=False))
+        bulk_size = 100
+        def get_bulk(client, i):
+            keys = [blobs[random.randrange(n)][0] for _ in range(bulk_size)]
+            return sum(len(b) for _, b in client.get_bulk(keys, compress=False))
+        results = {"put": load(url, nthreads, duration, put)}
+        KBClient(url, username="bench", password="bench").put_bulk(blobs)      # make sure all keys exist
+        results["get"] = load(url, nthreads, duration, get)
+        results["get_bulk"] = load(url, nthreads, duration, get_bulk)
+        results["get_bulk"]["blobs_per_request"] = bulk_size
+        results["blobs"] = n
+        results["blob_size"] = mean
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+def flatten(data, path=""):
+    # numeric leaves keyed by path, list items are labelled by their parameters
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if k not in ("time", "parameters"):
+                yield from flatten(v, path + "/" + k)
+    elif isinstance(data, list):
+        for i, item in enumerate(data):
+            label = str(i)
+            if isinstance(item, dict) and "blobs" in item:
+                label = "%s:%s" % (item.get("size_dist", ""), item["blobs"])
+            yield from flatten(item, path + "/" + label)
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        yield path, data
+
+def compare(old_path, new_path):
+    old = dict(flatten(json.load(open(old_path))))
+    new = dict(flatten(json.load(open(new_path))))
+    fmt = "%-70s %14s %14s %8s"
+    print(fmt % ("Metric", "Old", "New", "New/Old"))
+    for path, value in new.items():
+        if path in old and path.rsplit("/", 1)[-1] in ("ops_per_sec", "MB_per_sec", "hit_ratio", "p50", "p99",
+                        "open_seconds", "read_directory_seconds", "load_files_seconds",
+                        "first_get_seconds"):
+            ratio = "%.3f" % (value/old[path],) if old[path] else "-"
+            print(fmt % (path, "%.4g" % (old[path],), "%.4g" % (value,), ratio))
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["compare"]:
+        compare(*sys.argv[2:4])
+        sys.exit(0)
+
+
+    opts, args = getopt.getopt(sys.argv[1:], "ho:n:s:b:c:z:t:d:r:p:")
+    opts = dict(opts)
+    if "-h" in opts:
+        print(Usage)
+        sys.exit(2)
+
+    suites = args or ["file", "storage", "cache", "server"]
+    counts = [int(x) for x in opts.get("-n", "1000,10000").split(",")]
+    dists = opts.get("-s", "fixed,uniform,lognormal").split(",")
+    mean = int(opts.get("-b", 1000))
+    capacity = int(opts.get("-c", 1000))
+    exponent = float(opts.get("-z", 1.1))
+    nthreads = int(opts.get("-t", 8))
+    duration = float(opts.get("-d", 5))
+    seed = int(opts.get("-r", 0))
+    partitions = int(opts["-p"]) if "-p" in opts else None
+    random.seed(seed)
+
+    results = {
+        "time":         time.time(),
+        "python":       platform.python_version(),
+        "platform":     platform.platform(),
+        "parameters":   {
+            "counts": counts, "size_dists": dists, "mean_size": mean, "cache_capacity": capacity,
+            "zipf_exponent": exponent, "threads": nthreads, "duration": duration, "seed": seed,
+            "partitions": partitions
+        }
+    }
+    work_dir = tempfile.mkdtemp(prefix="kbbench.")
+    try:
+        for suite in suites:
+            print("running", suite, "...", file=sys.stderr)
+            if suite == "file":
+                results["file"] = bench_file(work_dir, counts, dists, mean)
+            elif suite == "storage":
+                results["storage"] = bench_storage(work_dir, counts, dists, mean, partitions)
+            elif suite == "cache":
+                results["cache"] = bench_cache(work_dir, counts, mean, capacity, exponent)
+            elif suite == "server":
+                results["server"] = bench_server(work_dir, max(counts), mean, nthreads, duration)
+            else:
+                print("Unknown suite:", suite, file=sys.stderr)
+                sys.exit(2)
+    finally:
+        shutil.rmtree(work_dir)
+
+    out = json.dumps(results, indent=2)
+    if "-o" in opts:
+        with open(opts["-o"], "w") as f:
+            f.write(out)
+    else:
+        print(out)
@@ -0,0 +1,80 @@
+import struct
+
+from .util import to_bytes
+
+class Archive(object):
+
+    #
+    # Streaming archive format used by export/import:
+    #   signature = b"KbA!" - 4 bytes
+    #   format version - 2 bytes (major, minor)
+    #   records:
+    #       key length - 4 bytes
+    #       blob size - 8 bytes
+    #       expiration time, unix seconds - 8 bytes, 0 = never
+    #       key
+    #       blob
+    #   end of archive:
+    #       key length = 0xFFFFFFFF, blob size = number of records, expiration time = 0
+    #
+
+    SIGNATURE = b"KbA!"
+    FORMAT_VERSION = (1,0)
+    RECORD = struct.Struct("!IQQ")
+    END = 0xFFFFFFFF
+
+class ArchiveWriter(Archive):
+
+    def __init__(self, stream):
+        self.Stream = stream
+        self.Count = 0
+        self.Stream.write(self.SIGNATURE + struct.pack("!BB", *self.FORMAT_VERSION))
+
+    def write(self, key, blob, expires=None):
+        key = to_bytes(key)
+        self.Stream.write(self.RECORD.pack(len(key), len(blob), int(expires or 0)))
+        self.Stream.write(key)
+        self.Stream.write(blob)
+        self.Count += 1
+
+    def close(self):
+        # writes the end of archive record, the stream is left open
+        self.Stream.write(self.RECORD.pack(self.END, self.Count, 0))
+        self.Stream.flush()
+
+class ArchiveReader(Archive):
+
+    def __init__(self, stream):
+        self.Stream = stream
+        header = self.read(len(self.SIGNATURE) + 2)
+        if header[:len(self.SIGNATURE)] != self.SIGNATURE:
+            raise ValueError("Not a KB archive")
+        version = tuple(header[len(self.SIGNATURE):])
+        if version[0] != self.FORMAT_VERSION[0]:
+            raise ValueError("Unsupported archive format version %d.%d" % version)
+
+    def read(self, n):
+        data = self.Stream.read(n)
+        if len(data) < n:
+            # the stream may return less data than requested
+            parts = [data]
+            while n > len(data) and parts[-1]:
+                parts.append(self.Stream.read(n - len(data)))
+                data = b''.join(parts)
+            if len(data) < n:
+                raise ValueError("Truncated archive")
+        return data
+
+    def __iter__(self):
+        # yields (key, blob, expires)
+        count = 0
+        while True:
+            key_length, size, expires = self.RECORD.unpack(self.read(self.RECORD.size))
+            if key_length == self.END:
+                if size != count:
+                    raise ValueError("Corrupted archive: %d records read, %d expected" % (count, size))
+                return
+            key = self.read(key_length)
+            blob = self.read(size)
+            count += 1
+            yield key, blob, (expires or None)
@@ -0,0 +1,51 @@
+import heapq
+
+class ExpiryIndex(object):
+
+    #
+    # Heap of (expiration time, key) with lazy deletion: entries for removed or re-timed keys
+    # stay in the heap and are skipped when popped
+    #
+
+    def __init__(self):
+        self.Heap = []
+        self.Expires = {}       # key -> expiration time
+
+    def __len__(self):
+        return len(self.Expires)
+
+    def __contains__(self, key):
+        return key in self.Expires
+
+    def add(self, key, expires):
+        if expires is None:
+            self.remove(key)
+            return
+        if self.Expires.get(key) != expires:
+            self.Expires[key] = expires
+            heapq.heappush(self.Heap, (expires, key))
+            if len(self.Heap) > 2*len(self.Expires) + 1000:
+                # too many stale entries
+                self.Heap = [(t, k) for k, t in self.Expires.items()]
+                heapq.heapify(self.Heap)
+
+    def remove(self, key):
+        self.Expires.pop(key, None)
+
+    def get(self, key):
+        return self.Expires.get(key)
+
+    def is_expired(self, key, now):
+        expires = self.Expires.get(key)
+        return expires is not None and expires <= now
+
+    def pop_expired(self, now, limit=None):
+        # removes and returns keys expired by now
+        out = []
+        heap = self.Heap
+        while heap and heap[0][0] <= now and (limit is None or len(out) < limit):
+            expires, key = heapq.heappop(heap)
+            if self.Expires.get(key) == expires:
+                del self.Expires[key]
+                out.append(key)
+        return out
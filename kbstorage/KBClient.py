@@ -0,0 +1,383 @@
+from pythreader import Primitive, synchronized
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urlsplit, urlencode
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect
+from hashlib import sha1
+import json, zlib, re, hashlib, secrets, heapq, queue
+
+from .util import random_key, to_bytes, to_str
+
+class KBClientError(Exception):
+
+    def __init__(self, status, message=""):
+        Exception.__init__(self, status, message)
+        self.Status = status
+        self.Message = message
+
+    def __str__(self):
+        return "HTTP status %s: %s" % (self.Status, self.Message)
+
+def parse_bulk(stream, chunk_size=64*1024, expires=False):
+    #
+    # Parses get_bulk response stream incrementally: <flags>[@<expiration time>], <key> <size>:<blob> ...
+    # yields (key, blob) pairs with blobs decompressed, or (key, blob, expiration time or None) if expires=True
+    #
+    buf = b''
+    start = 0           # start of the unparsed data in buf, the buffer is compacted once per read
+    while True:
+        pos = start
+        while True:
+            colon = buf.find(b':', pos)
+            if colon >= 0:
+                if buf[start:colon].rsplit(b' ', 1)[-1].isdigit():
+                    break
+                pos = colon + 1
+                continue
+            data = stream.read(chunk_size)
+            if not data:
+                if start < len(buf):
+                    raise ValueError("Incomplete bulk response")
+                return
+            buf = buf[start:] + data
+            pos -= start
+            start = 0
+        header = buf[start:colon]
+        start = colon + 1
+        flags, specs = header.split(b',', 1)
+        flags, _, expiration = flags.partition(b'@')
+        key, size = specs.strip().rsplit(b' ', 1)
+        size = int(size)
+        if len(buf) - start < size:
+            parts = [buf[start:]]
+            n = len(parts[0])
+            while n < size:
+                data = stream.read(max(chunk_size, size - n))
+                if not data:
+                    raise ValueError("Incomplete bulk response")
+                parts.append(data)
+                n += len(data)
+            buf = b''.join(parts)
+            start = 0
+        blob = buf[start:start+size]
+        start += size
+        if b'z' in flags:
+            blob = zlib.decompress(blob)
+        if expires:
+            yield key, blob, (int(expiration) if expiration else None)
+        else:
+            yield key, blob
+
+class DigestAuth(object):
+
+    #
+    # RFC 2617 digest authentication client, compatible with server/rfc2617.py.
+    # The challenge (nonce) is reused for subsequent requests until the server rejects it
+    #
+
+    Algorithms = {"MD5": "md5", "SHA-256": "sha256"}
+
+    def __init__(self, username, password):
+        self.Username = username
+        self.Password = password
+        self.Challenge = None
+        self.NC = 0
+
+    def challenge(self, header):
+        self.Challenge = dict((k, v) for k, _, v in re.findall(r'(\w+)=("?)(.*?)\2(?:,\s*|$)', header))
+        self.NC = 0
+
+    def header(self, method, uri):
+        if self.Challenge is None:
+            return None
+        challenge = self.Challenge
+        algorithm = self.Algorithms.get(challenge.get("algorithm", "MD5").upper(), "md5")
+        def checksum(data):
+            return hashlib.new(algorithm, data.encode("utf-8")).hexdigest()
+        self.NC += 1
+        nc = "%08x" % (self.NC,)
+        cnonce = secrets.token_hex(8)
+        realm, nonce, qop = challenge.get("realm", ""), challenge.get("nonce", ""), "auth"
+        a1 = checksum("%s:%s:%s" % (self.Username, realm, self.Password))
+        a2 = checksum("%s:%s" % (method, uri))
+        response = checksum("%s:%s:%s:%s:%s:%s" % (a1, nonce, nc, cnonce, qop, a2))
+        return ('Digest username="%s", realm="%s", nonce="%s", uri="%s", algorithm=%s, '
+                'qop=%s, nc=%s, cnonce="%s", response="%s"') % (
+                    self.Username, realm, nonce, uri, challenge.get("algorithm", "MD5"), qop, nc, cnonce, response)
+
+class ConnectionPool(Primitive):
+
+    def __init__(self, url, size=10, timeout=None):
+        Primitive.__init__(self)
+        parts = urlsplit(url)
+        self.Scheme = parts.scheme or "http"
+        self.Host = parts.hostname
+        self.Port = parts.port
+        self.Prefix = parts.path.rstrip("/")
+        self.Size = size
+        self.Timeout = timeout
+        self.Idle = []
+
+    @synchronized
+    def connection(self):
+        if self.Idle:
+            return self.Idle.pop()
+        connection_class = HTTPSConnection if self.Scheme == "https" else HTTPConnection
+        return connection_class(self.Host, self.Port, timeout=self.Timeout)
+
+    @synchronized
+    def release(self, connection, reuse=True):
+        if reuse and len(self.Idle) < self.Size:
+            self.Idle.append(connection)
+        else:
+            connection.close()
+
+    @synchronized
+    def close(self):
+        for connection in self.Idle:
+            connection.close()
+        self.Idle = []
+
+class KBClient(object):
+
+    #
+    # Client for a single KBServer instance
+    #
+
+    def __init__(self, url, username=None, password=None, pool_size=10, timeout=None):
+        self.URL = url.rstrip("/")
+        self.Pool = ConnectionPool(self.URL, size=pool_size, timeout=timeout)
+        self.Auth = DigestAuth(username, password) if username is not None else None
+
+    def close(self):
+        self.Pool.close()
+
+    def _send(self, method, uri, body, headers):
+        # returns (connection, response). Retries once on a fresh connection if the kept-alive one was closed by the server
+        for attempt in (0, 1):
+            connection = self.Pool.connection()
+            try:
+                connection.request(method, uri, body=body, headers=headers)
+                return connection, connection.getresponse()
+            except (HTTPException, ConnectionError):
+                connection.close()
+                if attempt:
+                    raise
+
+    def request(self, method, path, body=None, headers={}, auth=False, **args):
+        # returns (connection, response), the caller must read the response and call done()
+        uri = self.Pool.Prefix + "/" + path
+        args = {k: v for k, v in args.items() if v is not None}
+        if args:
+            uri += "?" + urlencode(args)
+        headers = dict(headers)
+        for attempt in (0, 1):
+            if auth and self.Auth is not None:
+                auth_header = self.Auth.header(method, uri)
+                if auth_header:
+                    headers["Authorization"] = auth_header
+            connection, response = self._send(method, uri, body, headers)
+            if response.status == 401 and auth and self.Auth is not None and not attempt:
+                self.Auth.challenge(response.getheader("WWW-Authenticate", ""))
+                self.done(connection, response)
+                continue
+            break
+        return connection, response
+
+    def done(self, connection, response):
+        response.read()
+        self.Pool.release(connection, reuse=not response.will_close)
+
+    def call(self, method, path, body=None, headers={}, auth=False, **args):
+        connection, response = self.request(method, path, body=body, headers=headers, auth=auth, **args)
+        data = response.read()
+        self.done(connection, response)
+        if response.status == 404:
+            raise KeyError(args.get("key"))
+        if response.status // 100 != 2:
+            raise KBClientError(response.status, to_str(data))
+        return data
+
+    def get(self, key, compress=True):
+        blob = self.call("GET", "blob", key=to_str(key), compress="yes" if compress else "no")
+        if compress:
+            blob = zlib.decompress(blob)
+        return blob
+
+    __getitem__ = get
+
+    def put(self, key, blob):
+        key = to_str(key) if key is not None else None
+        return to_bytes(self.call("PUT", "blob", body=to_bytes(blob), auth=True, key=key))
+
+    __setitem__ = put
+
+    def keys(self, prefix=None, min_key=None, max_key=None, pattern=None, after=None, page_size=1000):
+        # iterates over keys in sorted order, fetching them in pages
+        while True:
+            data = self.call("GET", "keys", prefix=prefix, min_key=min_key, max_key=max_key, pattern=pattern,
+                    after=to_str(after) if after is not None else None, limit=page_size)
+            keys = [to_bytes(k) for k in data.decode("utf-8").split("\n") if k]
+            yield from keys
+            if len(keys) < page_size:
+                break
+            after = keys[-1]
+
+    def get_bulk(self, keys, compress=True, expires=False):
+        # yields (key, blob) for existing keys, streaming. With expires=True, yields (key, blob, expiration time or None)
+        body = "\n".join(to_str(k) for k in keys).encode("utf-8")
+        connection, response = self.request("POST", "get_bulk", body=body, headers={"Content-Type": "text/csv"},
+                    compress="yes" if compress else "no")
+        if response.status // 100 != 2:
+            data = response.read()
+            self.done(connection, response)
+            raise KBClientError(response.status, to_str(data))
+        try:
+            yield from parse_bulk(response, expires=expires)
+        except:
+            connection.close()
+            raise
+        else:
+            self.done(connection, response)
+
+    def put_bulk(self, items):
+        return [self.put(key, blob) for key, blob in items]
+
+    def scan(self, prefix=None, min_key=None, max_key=None, compress=True, expires=False):
+        # yields (key, blob) for all blobs in the server's physical order, see get_bulk() for expires
+        connection, response = self.request("GET", "scan", prefix=prefix, min_key=min_key, max_key=max_key,
+                    compress="yes" if compress else "no")
+        if response.status // 100 != 2:
+            data = response.read()
+            self.done(connection, response)
+            raise KBClientError(response.status, to_str(data))
+        try:
+            yield from parse_bulk(response, expires=expires)
+        except:
+            connection.close()
+            raise
+        else:
+            self.done(connection, response)
+
+    def changes(self, epoch=None, since=None, limit=None):
+        return json.loads(self.call("GET", "changes", epoch=epoch, since=since, limit=limit))
+
+class HashRing(object):
+
+    def __init__(self, nodes, replicas=100):
+        self.Nodes = list(nodes)
+        points = []
+        for node in self.Nodes:
+            for i in range(replicas):
+                points.append((self.hash("%s#%d" % (node, i)), node))
+        points.sort()
+        self.Points = [h for h, _ in points]
+        self.Owners = [node for _, node in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(sha1(to_bytes(key)).digest()[:8], "big")
+
+    def node(self, key):
+        i = bisect(self.Points, self.hash(key)) % len(self.Points)
+        return self.Owners[i]
+
+class KBShardedClient(object):
+
+    #
+    # Distributes keys across several KBServer instances using consistent hashing.
+    # Bulk operations are sent to the shards in parallel
+    #
+
+    def __init__(self, urls, username=None, password=None, replicas=100, pool_size=10, timeout=None):
+        self.Clients = {url: KBClient(url, username=username, password=password, pool_size=pool_size, timeout=timeout)
+                        for url in urls}
+        self.Ring = HashRing(self.Clients.keys(), replicas=replicas)
+        self.PoolSize = pool_size
+        self.Executor = ThreadPoolExecutor(max_workers=max(1, len(self.Clients) * pool_size))
+
+    def close(self):
+        self.Executor.shutdown()
+        for client in self.Clients.values():
+            client.close()
+
+    def client(self, key):
+        return self.Clients[self.Ring.node(key)]
+
+    def partition(self, keys):
+        shards = {}
+        for key in keys:
+            shards.setdefault(self.Ring.node(key), []).append(key)
+        return shards
+
+    def get(self, key, compress=True):
+        return self.client(key).get(key, compress=compress)
+
+    __getitem__ = get
+
+    def put(self, key, blob):
+        if key is None:
+            key = random_key()
+        return self.client(key).put(key, blob)
+
+    __setitem__ = put
+
+    def keys(self, **args):
+        # merges sorted key streams from all shards
+        return heapq.merge(*[client.keys(**args) for client in self.Clients.values()])
+
+    def merge_streams(self, streams):
+        # yields items from several iterators as they arrive
+        results = queue.Queue()
+        done = object()
+        def fetch(stream):
+            try:
+                for item in stream:
+                    results.put(item)
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(done)
+        for stream in streams:
+            self.Executor.submit(fetch, stream)
+        remaining = len(streams)
+        while remaining:
+            item = results.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+
+    def get_bulk(self, keys, compress=True, expires=False):
+        # yields (key, blob) pairs as they arrive from the shards
+        shards = self.partition(keys)
+        return self.merge_streams([self.Clients[url].get_bulk(shard_keys, compress=compress, expires=expires)
+                    for url, shard_keys in shards.items()])
+
+    def scan(self, **args):
+        # scans all shards in parallel
+        return self.merge_streams([client.scan(**args) for client in self.Clients.values()])
+
+    def put_bulk(self, items):
+        # returns list of keys in the order of the items
+        items = [(key if key is not None else random_key(), blob) for key, blob in items]
+        shards = {}
+        for i, (key, blob) in enumerate(items):
+            shards.setdefault(self.Ring.node(key), []).append((i, key, blob))
+        def put(url, shard_items):
+            client = self.Clients[url]
+            return [(i, client.put(key, blob)) for i, key, blob in shard_items]
+        futures = []
+        for url, shard_items in shards.items():
+            # up to PoolSize concurrent requests per shard
+            n = self.PoolSize
+            for j in range(n):
+                if shard_items[j::n]:
+                    futures.append(self.Executor.submit(put, url, shard_items[j::n]))
+        out = [None] * len(items)
+        for future in futures:
+            for i, key in future.result():
+                out[i] = key
+        return out
@@ -1,4 +1,4 @@
-import struct, json
+import struct, json, os
 
 from .util import to_str, to_bytes, random_key
 
@@ -15,13 +15,18 @@ class KBFile(object):
     KEY_SIZE_BYTES = 2                # length of key size field in bytes: max key size = 2**(8*2) = 65536
     SIGNATURE = b"KbF!"
     HEADER_SIZE = len(SIGNATURE) + 2 + 2*SIZE_BYTES     # signature + version + data_offset + directory_offset
-    FORMAT_VERSION = (3,0)
+    FORMAT_VERSION = (3,2)
     ZERO_PAGE = b'\0' * PAGE_SIZE
     MAX_FILE_SIZE = 1024*1024*1024       # 1GB
     
     MAX_BLOB_SIZE = 2**(8*8)-1
     MAX_OFFSET = 2**(8*8)-1
     MAX_KEY_SIZE = 2**(8*4)-1
+
+    FLAG_EXPIRES = 1                # directory entry is followed by 8 bytes of expiration time
+    FLAG_EXTERNAL = 2               # the data is a reference to a separate extent file, see KBStorage
+    FLAG_DIGEST = 4                 # directory entry is followed by the content digest, see KBStorage deduplication
+    DIGEST_SIZE = 32
     
     #
     # File format:
@@ -45,16 +50,29 @@ class KBFile(object):
     #           key - <key length>
     #           ...
     #
+    #   Format 3.2 directory entry:
+    #       flags - 1 byte
+    #       lengths mask - 1 byte: offset length log2 (3 bits), size length log2 (3 bits), key length log2 (2 bits)
+    #       offset, size, key length - variable length
+    #       key
+    #       expiration time, unix seconds - 8 bytes, present if flags & FLAG_EXPIRES
+    #       content digest - 32 bytes (DIGEST_SIZE), present if flags & FLAG_DIGEST (added in 3.2)
+    #
     
     def __init__(self, path, name=None):
         self.Name = name or path.rsplit("/",1)[-1].split(".", 1)[0]
         self.Path = path
         self.F = None
         self.Directory = {}         # key -> (offset, size, flags)
+        self.Expiry = {}            # key -> expiration time, for keys with FLAG_EXPIRES
+        self.Digests = {}           # key -> content digest, for keys with FLAG_DIGEST
         self.DataOffset = self.DirectoryOffset = None
         self.FreeSpace = None
         self.FileSize = None
         self.Version = self.Signature = None
+        self.DeferDirectory = False     # if True, directory entries for new blobs are written by write_pending()
+        self.PendingEntries = []        # [(seq, flags, key, offset, size), ...]
+        self.PendingSeq = 0
         
     def _open(self):
         self.F = open(self.Path, "r+b")
@@ -87,6 +105,9 @@ class KBFile(object):
         return f
         
     def close(self):
+        if self.PendingEntries:
+            self.sync()
+            self.write_pending()
         self.F.close()
         self.Directory = self.DataOffset = self.DirectoryOffset = self.FreeSpace = None
 
@@ -135,10 +156,14 @@ class KBFile(object):
     #           ...
 
     def write_directory(self):
+        if self.PendingEntries:
+            # the rewritten directory will include pending entries, make sure their data is on disk first
+            self.sync()
+            self.PendingEntries = []
         offset = self.DirectoryOffset
         self.F.seek(offset, 0)
-        for key, (offset, size) in self.Directory.items():
-            self.F.write(self.pack_directory_entry(key, offset, size))
+        self.F.write(b''.join(self.pack_directory_entry(flags, key, offset, size, self.Expiry.get(key), self.Digests.get(key))
+                for key, (offset, size, flags) in self.Directory.items()))
         self.F.truncate()
 
     def ___pack_directory_entry(self, key, offset, size):
@@ -165,7 +190,7 @@ class KBFile(object):
             nbytes *= 2
         return m, x.to_bytes(nbytes, "big")
         
-    def pack_directory_entry(self, flags, key, offset, data_size):
+    def pack_directory_entry(self, flags, key, offset, data_size, expires=None, digest=None):
         assert flags < 256 and flags >= 0
         key_size = len(key)
         key_size_log, key_size_bytes = self.pack256(key_size)
@@ -180,8 +205,13 @@ class KBFile(object):
         assert lenmask < 256
 
         out = bytes([flags, lenmask]) + offset_bytes + data_size_bytes + key_size_bytes + bytes(key)
+        if flags & self.FLAG_EXPIRES:
+            out += struct.pack("!Q", int(expires))
+        if flags & self.FLAG_DIGEST:
+            assert len(digest) == self.DIGEST_SIZE
+            out += digest
 
-        print("pack_directory_entry: out:", out.hex(), repr(out))
+        #print("pack_directory_entry: out:", out.hex(), repr(out))
         return out
 
     def unpack_directory_entry(self, data):
@@ -206,7 +236,15 @@ class KBFile(object):
         i += key_size_len
         key = bytes(data[i:i+key_size])
         i += key_size        
-        return flags, offset, data_size, bytes(key), i
+        expires = None
+        if flags & self.FLAG_EXPIRES:
+            expires = struct.unpack("!Q", data[i:i+8])[0]
+            i += 8
+        digest = None
+        if flags & self.FLAG_DIGEST:
+            digest = bytes(data[i:i+self.DIGEST_SIZE])
+            i += self.DIGEST_SIZE
+        return flags, offset, data_size, bytes(key), expires, digest, i
 
     def read_directory(self):
         self.F.seek(self.directory_offset, 0)
@@ -215,12 +253,22 @@ class KBFile(object):
         n = len(data)
         #print(f"read_directory: dir data ({n}):", data[:20].hex(), data[:20])
         self.Directory = {}
+        self.Expiry = {}
+        self.Digests = {}
         view = memoryview(data)
         l = len(view)
         self.FreeSpace = self.DataOffset        
         while i < l:
-            flags, offset, size, key, consumed = self.unpack_directory_entry(view[i:])
+            flags, offset, size, key, expires, digest, consumed = self.unpack_directory_entry(view[i:])
             self.Directory[key] = (offset, size, flags)
+            if expires is not None:
+                self.Expiry[key] = expires
+            else:
+                self.Expiry.pop(key, None)
+            if digest is not None:
+                self.Digests[key] = digest
+            else:
+                self.Digests.pop(key, None)
             #print("data", key, "end:", offset+size)
             self.FreeSpace = max(self.FreeSpace, offset+size)            
             i += consumed
@@ -241,26 +289,87 @@ class KBFile(object):
             self.read_header()
         return self.DirectoryOffset
 
-    def append_blob(self, key, blob, offset, flags=0):
+    def append_blob(self, key, blob, offset, flags=0, expires=None, digest=None):
         # assume there is enough room to store the blob at given offset
         #print(f"append_blob({key}) at {offset}")
         self.F.seek(offset, 0)
         self.F.write(blob)
         self.FreeSpace = self.F.tell()
-        self.F.seek(0, 2)
-        self.F.write(self.pack_directory_entry(flags, key, offset, len(blob)))
-        self.F.truncate()
-        self.Directory[key] = (offset, len(blob), flags)
+        self.append_directory_entry(key, offset, len(blob), flags, expires, digest)
 
-    def add_blob(self, key, blob):
-        if len(key) > self.MAX_KEY_SIZE:
-            raise ValueError("Key is too long: %d > %d" % (len(key), self.MAX_KEY_SIZE))
+    def append_directory_entry(self, key, offset, size, flags=0, expires=None, digest=None):
+        flags &= ~(self.FLAG_EXPIRES | self.FLAG_DIGEST)
+        if expires is not None:
+            flags |= self.FLAG_EXPIRES
+            self.Expiry[key] = expires
+        else:
+            self.Expiry.pop(key, None)
+        if digest is not None:
+            flags |= self.FLAG_DIGEST
+            self.Digests[key] = digest
+        else:
+            self.Digests.pop(key, None)
+        if self.DeferDirectory:
+            self.PendingSeq += 1
+            self.PendingEntries.append((self.PendingSeq, flags, key, offset, size))
+        else:
+            self.F.seek(0, 2)
+            self.F.write(self.pack_directory_entry(flags, key, offset, size, expires, digest))
+            self.F.truncate()
+        self.Directory[key] = (offset, size, flags)
+
+    def add_alias(self, key, existing_key, expires=None):
+        # adds key pointing to the same data as existing_key, the data is shared
+        key = to_bytes(key)
+        existing_key = to_bytes(existing_key)
+        offset, size, flags = self.Directory[existing_key]
+        if key in self:
+            del self[key]
+        self.append_directory_entry(key, offset, size, flags, expires, self.Digests.get(existing_key))
+        return key
+
+    def write_pending(self, seq=None):
+        # appends pending directory entries up to seq to the directory, the caller is responsible for
+        # making sure their data is already on disk
+        entries = [e for e in self.PendingEntries if seq is None or e[0] <= seq]
+        if entries:
+            self.PendingEntries = self.PendingEntries[len(entries):]
+            self.F.seek(0, 2)
+            self.F.write(b''.join(self.pack_directory_entry(flags, key, offset, size, self.Expiry.get(key), self.Digests.get(key))
+                    for _, flags, key, offset, size in entries))
+        return len(entries)
+
+    def append_bulk(self, key, blob, flags=0, expires=None, digest=None):
+        # bulk loading of a new file: appends the blob after the end of the data, the directory and the header
+        # are written once by finish_bulk(). The file is not valid until then
+        self.DeferDirectory = True
+        key = to_bytes(key)
+        self.append_blob(key, blob, self.FreeSpace, flags, expires, digest)
+        return key
+
+    def finish_bulk(self):
+        self.DirectoryOffset = self.next_page_offset(self.FreeSpace)
+        self.write_header()
+        self.write_directory()
+        self.FileSize = self.F.tell()
+        self.DeferDirectory = False
+
+    def flush(self):
+        self.F.flush()
+
+    def sync(self):
+        self.F.flush()
+        os.fsync(self.F.fileno())
+
+    def add_blob(self, key, blob, expires=None, flags=0, digest=None):
         #print("add_blob: free space:", self.FreeSpace)
         if key is None:
             key = random_key()
             while key in self.Directory:
                 key = random_key()
         key = to_bytes(key)
+        if len(key) > self.MAX_KEY_SIZE:
+            raise ValueError("Key is too long: %d > %d" % (len(key), self.MAX_KEY_SIZE))
         
         if key in self:
             del self[key]
@@ -285,9 +394,9 @@ class KBFile(object):
         n = len(blob_map)
         last_i = n-1
         store_at = self.FreeSpace
-        for i, (offset, size, flags) in enumerate(blob_map):
+        for i, (offset, size, _) in enumerate(blob_map):
             if i < last_i:
-                o1, s1 = blob_map[i+1]
+                o1, s1, _ = blob_map[i+1]
                 #print("gap:", o1 - offset - size)
                 if o1 >= offset + size + l:
                     #print("add_blob: gap found")
@@ -309,7 +418,7 @@ class KBFile(object):
         #print("add_blob: adding at:", store_at)
         if store_at > self.MAX_OFFSET:
             raise ValueError("Offset is too long: %d > %d" % (store_at, self.MAX_OFFSET))
-        self.append_blob(key, blob, store_at)
+        self.append_blob(key, blob, store_at, flags=flags, expires=expires, digest=digest)
         return key
         
     __setitem__ = add_blob
@@ -338,7 +447,7 @@ class KBFile(object):
         
     def meta(self, key):
         offset, size, flags = self.Directory[key]
-        return {"size":size, "flags":flags}
+        return {"size":size, "flags":flags, "expires":self.Expiry.get(key)}
     
     def keys(self):
         return self.Directory.keys()
@@ -351,10 +460,70 @@ class KBFile(object):
         for k in self.keys():
             yield k, self[k]
 
+    def scan(self, keys=None, min_key=None, max_key=None, prefix=None, buffer_size=8*1024*1024, validate=None):
+        #
+        # Yields (key, blob, flags) in the order of the data offset, reading the data sequentially in large buffers
+        # through a separate file handle. The caller must flush pending writes before starting the scan.
+        # keys: optional set of keys to include
+        # validate: optional function called after each buffer read with [(key, (offset, size, flags)), ...],
+        #   returns the set of keys whose entries are still current. Other entries are skipped because their
+        #   space may have been reused by a concurrent write
+        #
+        entries = []
+        for key, (offset, size, flags) in list(self.Directory.items()):
+            if keys is not None and key not in keys:
+                continue
+            if prefix and not key.startswith(prefix):
+                continue
+            if min_key is not None and key < min_key:
+                continue
+            if max_key is not None and key >= max_key:
+                continue
+            entries.append((offset, size, key, flags))
+        entries.sort()
+        with open(self.Path, "rb") as f:
+            i = 0
+            n = len(entries)
+            while i < n:
+                # read a run of entries which fit in the buffer, or one larger blob
+                start = entries[i][0]
+                end = start + entries[i][1]
+                j = i + 1
+                while j < n and max(end, entries[j][0] + entries[j][1]) - start <= buffer_size:
+                    end = max(end, entries[j][0] + entries[j][1])
+                    j += 1
+                f.seek(start)
+                buf = memoryview(f.read(end - start))
+                run = entries[i:j]
+                if validate is not None:
+                    current = validate([(key, (offset, size, flags)) for offset, size, key, flags in run])
+                    run = [entry for entry in run if entry[2] in current]
+                for offset, size, key, flags in run:
+                    yield key, bytes(buf[offset-start:offset-start+size]), flags
+                i = j
+
     def __delitem__(self, key):
         key = to_bytes(key)
         del self.Directory[key]
+        self.Expiry.pop(key, None)
+        self.Digests.pop(key, None)
         self.write_directory()
+
+    def delete_blobs(self, keys):
+        # deletes multiple keys with a single directory rewrite
+        for key in keys:
+            key = to_bytes(key)
+            del self.Directory[key]
+            self.Expiry.pop(key, None)
+            self.Digests.pop(key, None)
+        self.write_directory()
+
+    def expires(self, key):
+        return self.Expiry.get(to_bytes(key))
+
+    def digest(self, key):
+        # content digest stored with the entry or None
+        return self.Digests.get(to_bytes(key))
         
     def directory(self):
         return sorted([(k, o, s) for k, (o, s, _) in self.Directory.items()], key=lambda x: x[1])
@@ -369,14 +538,20 @@ class KBFile(object):
     def compact(self):
         blobs = sorted([(offset, size, key, flags) for key, (offset, size, flags) in self.Directory.items()])
         new_directory = {}
+        moved = {}          # (old offset, size) -> new offset, for extents shared by several keys
         write_off = self.DataOffset
         for offset, size, key, flags in blobs:
+            extent = (offset, size)
+            if extent in moved:
+                new_directory[key] = (moved[extent], size, flags)
+                continue
             if offset > write_off:
                 self.F.seek(offset, 0)
                 blob = self.F.read(size)
                 self.F.seek(write_off, 0)
                 self.F.write(blob)
             new_directory[key] = (write_off, size, flags)
+            moved[extent] = write_off
             write_off += size
         self.DirectoryOffset = self.next_page_offset(write_off)
         self.write_header()
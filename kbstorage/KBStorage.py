@@ -1,24 +1,197 @@
-from pythreader import Primitive, synchronized
-import uuid, secrets, glob, os
-from hashlib import sha1
+from pythreader import Primitive, PyThread, synchronized
+import uuid, secrets, glob, os, time, queue, json, traceback
+from hashlib import sha1, sha256
 from .KBFile import KBFile, FileSizeLimitExceeded
+from .KeyIndex import KeyIndex
+from .ExpiryIndex import ExpiryIndex
+from .Archive import ArchiveWriter, ArchiveReader
 from .util import random_key, key_hash, to_str, to_bytes
 
+class WriteBehindError(Exception):
+
+    def __init__(self, errors):
+        Exception.__init__(self, "%d queued write(s) failed" % (len(errors),), errors)
+        self.Errors = errors        # [(key, exception), ...]
+
+class PeriodicThread(PyThread):
+
+    def __init__(self, function, interval):
+        PyThread.__init__(self, daemon=True)
+        self.Function = function
+        self.Interval = interval
+
+    def run(self):
+        while not self.Stop:
+            time.sleep(self.Interval)
+            try:
+                self.Function()
+            except Exception:
+                traceback.print_exc()       # keep running, the next call may succeed
+
+class ScanWorker(PyThread):
+
+    def __init__(self, storage, files, out, args, expires=False):
+        PyThread.__init__(self, daemon=True)
+        self.Storage = storage
+        self.Files = files          # queue.Queue of (KBFile, set of live keys)
+        self.Out = out
+        self.Args = args
+        self.Expires = expires
+
+    def run(self):
+        try:
+            while not self.Stop:
+                try:
+                    f, keys = self.Files.get_nowait()
+                except queue.Empty:
+                    break
+                for key, blob, flags in f.scan(keys=keys, validate=lambda entries: self.current(f, entries), **self.Args):
+                    if self.Stop:
+                        break
+                    if flags & KBFile.FLAG_EXTERNAL:
+                        try:
+                            blob = b''.join(self.Storage.read_extent(blob))
+                        except FileNotFoundError:
+                            continue        # replaced or deleted since the scan started
+                    if self.Expires:
+                        self.put((key, blob, self.Storage.Expiry.get(key)))
+                    else:
+                        self.put((key, blob))
+        except Exception as e:
+            self.put(e)
+        finally:
+            self.put(None)
+
+    def current(self, f, entries):
+        # keys whose directory entries have not changed since the scan started
+        with self.Storage:
+            if self.Storage.Files.get(f.Name) is not f:
+                return set()        # the file was removed
+            return {key for key, entry in entries
+                    if f.Directory.get(key) == entry and self.Storage.KeyMap.get(key) == f.Name}
+
+    def put(self, item):
+        # does not block after the scan is stopped, e.g. when the scan generator was abandoned
+        while not self.Stop:
+            try:
+                self.Out.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
 class KBStorage(Primitive):
+
+    #
+    # Durability modes:
+    #   "none"      - no fsync, the OS decides when the data gets to the disk
+    #   "periodic"  - changes are committed to disk every sync_interval seconds
+    #   "write"     - add_blob and delete_blob return after the change is committed to disk.
+    #                 Concurrent writers share a single group commit
+    #
+    # In "periodic" and "write" modes, a commit syncs the blob data first and only then appends the
+    # directory entries, so that a crash never leaves a directory entry pointing to unwritten data
+    #
+    # Deduplication: if dedup=True, a blob with the same content as an already stored one is stored as
+    # a directory entry pointing to the existing data. The data is released when the last key referring
+    # to it is deleted
+    #
+    # Expiration: a blob can be stored with an expiration time (unix seconds). Expired blobs are invisible
+    # to readers immediately and are removed in batches by expire(), called every expire_interval seconds
+    # if specified. Files which contain only expired blobs are removed as a whole
+    #
+    # Large blobs: blobs larger than large_blob_threshold bytes are stored in their own extent files
+    # (<name>.kbe, raw data). The .kbf file stores only a reference "<extent name> <size>" flagged
+    # with FLAG_EXTERNAL, so compaction never copies large blobs. Extent files are written and read
+    # in chunks, see add_stream() and iter_blob()
+    #
+    # Partitioned layout: if partitions=N, the key hash (util.key_hash) determines the partition the key
+    # belongs to. Files and extents of partition p are stored in <root>/<p as 4 hex digits>/ and their names
+    # start with the partition number. Partitions are loaded on first access, operations over the whole
+    # storage (keys(), scan(), ...) load all of them. The layout is recorded in <root>/layout.json
+    #
+
+    DURABILITY_MODES = ("none", "periodic", "write")
+    CHUNK_SIZE = 1024*1024
     
-    def __init__(self, root_path, lock=None):
+    def __init__(self, root_path, lock=None, change_log=None, durability="none", sync_interval=1.0, dedup=False,
+                expire_interval=None, large_blob_threshold=None, partitions=None):
         Primitive.__init__(self, lock=lock)
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError("Unknown durability mode: %s" % (durability,))
         self.RootPath = root_path
+        self.ChangeLog = change_log     # Replication.ChangeLog, if replicated
+        self.Durability = durability
         self.Files = {}     # name -> KBFile
         self.KeyMap = {}    # key -> file name
-        self.CurrentFile = None     # file new entries are written to
+        self.Index = KeyIndex()     # sorted keys
+        self.CurrentFiles = {}      # partition (None if not partitioned) -> file new entries are written to
+        self.WriteSeq = self.SyncedSeq = 0
+        self.DirtyFiles = set()     # names of files modified since last commit
+        self.NewDirs = set()        # directories with files created since last commit
+        self.DeadExtents = set()    # names of unreferenced extents to remove after next commit
+        self.Committing = False
+        self.Dedup = dedup
+        self.Contents = {}          # content digest -> set of keys
+        self.KeyDigests = {}        # key -> content digest
+        self.Expiry = ExpiryIndex()
+        self.LargeBlobThreshold = large_blob_threshold
+        self.ExtentRefs = {}        # extent name -> set of keys
+        self.KeyExtents = {}        # key -> extent name
+        self.WritingExtents = set() # names of extents being written, not referenced yet
+        self.Partitions = self.load_layout(partitions)
+        self.Loaded = set()         # loaded partitions
         self.load_files()
+        self.SyncThread = self.ExpiryThread = None
+        if durability == "periodic":
+            self.SyncThread = PeriodicThread(self.commit, sync_interval)
+            self.SyncThread.start()
+        if expire_interval:
+            self.ExpiryThread = PeriodicThread(self.expire, expire_interval)
+            self.ExpiryThread.start()
     
+    def load_layout(self, partitions):
+        # returns number of partitions, None for the original layout
+        path = f"{self.RootPath}/layout.json"
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                layout = json.load(f)
+            if partitions is not None and partitions != layout.get("partitions"):
+                raise ValueError("The storage has %s partitions" % (layout.get("partitions"),))
+            return layout.get("partitions")
+        if partitions:
+            if not 0 < partitions <= 0x10000:
+                raise ValueError("Number of partitions must be between 1 and 65536")
+            if glob.glob(f"{self.RootPath}/*/*/*.kbf"):
+                raise ValueError("Can not partition existing storage")
+            os.makedirs(self.RootPath, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump({"partitions": partitions}, f)
+        return partitions or None
+
+    def partition(self, key):
+        # None if not partitioned
+        return key_hash(key, self.Partitions) if self.Partitions else None
+
+    def partition_dir(self, partition):
+        return "%s/%04x" % (self.RootPath, partition)
+
+    def new_name(self, partition=None):
+        # name for a new file or extent
+        name = random_key()
+        if partition is not None:
+            name = "%04x-%s" % (partition, name)
+        return name
+
     def name_to_dir(self, name):
+        if self.Partitions:
+            return self.partition_dir(int(name.split("-", 1)[0], 16))
         x = name[-1]
         y = name[-2]
         return f"{self.RootPath}/{x}/{y}"
 
+    def name_to_partition(self, name):
+        return int(name.split("-", 1)[0], 16) if self.Partitions else None
+
     def name_to_path(self, name):
         dir_path = self.name_to_dir(name)
         return f"{dir_path}/{name}.kbf"
@@ -28,55 +201,772 @@ class KBStorage(Primitive):
 
     @synchronized
     def load_files(self):
+        if self.Partitions:
+            return          # loaded on first access, see load_partition()
         smallest_file = None
         smallest_size = None
         for path in glob.glob(f"{self.RootPath}/*/*/*.kbf"):
             f = KBFile.open(path)
+            f.DeferDirectory = self.Durability != "none"
             self.Files[f.Name] = f
             for k in f.keys():
                 self.KeyMap[k] = f.Name
+                self.Expiry.add(k, f.expires(k))
             size = f.size
             if smallest_file is None or size < smallest_size:
                 smallest_file = f
                 smallest_size = size
-        self.CurrentFile = smallest_file
+        self.Index.load(self.KeyMap.keys())
+        # remove files left over by interrupted bulk operations
+        for path in glob.glob(f"{self.RootPath}/*/*/*.kbf.tmp"):
+            os.remove(path)
+        self.load_extents()
+        if self.Dedup:
+            self.load_contents()
         #print("smallest file:", smallest_file.Name, smallest_size)
-        if self.CurrentFile is None:
-            self.CurrentFile = self.new_file()
+        self.CurrentFiles[None] = smallest_file or self.new_file()
+
+    @synchronized
+    def load_partition(self, partition):
+        if partition in self.Loaded:
+            return
+        dir_path = self.partition_dir(partition)
+        files = []
+        for path in glob.glob(f"{dir_path}/*.kbf"):
+            f = KBFile.open(path)
+            f.DeferDirectory = self.Durability != "none"
+            self.Files[f.Name] = f
+            files.append(f)
+            for k in f.keys():
+                if k not in self.KeyMap:
+                    self.Index.add(k)
+                self.KeyMap[k] = f.Name
+                self.Expiry.add(k, f.expires(k))
+        for path in glob.glob(f"{dir_path}/*.kbf.tmp"):
+            os.remove(path)
+        self.load_extents(files, f"{dir_path}/*.kbe")
+        if self.Dedup:
+            self.load_contents(files)
+        if files:
+            self.CurrentFiles[partition] = min(files, key=lambda f: f.size)
+        self.Loaded.add(partition)
+
+    def load_key(self, key):
+        # makes sure the partition of the key is loaded
+        if self.Partitions:
+            partition = key_hash(key, self.Partitions)
+            if partition not in self.Loaded:
+                self.load_partition(partition)
+
+    @synchronized
+    def load_all(self):
+        if self.Partitions:
+            for partition in range(self.Partitions):
+                self.load_partition(partition)
 
     @synchronized
     def reload(self):
+        self.commit()
         self.Files = {}     # name -> KBFile
         self.KeyMap = {}    # key -> file name
-        self.CurrentFile = None     # file new entries are written to
+        self.Index = KeyIndex()
+        self.Contents = {}
+        self.KeyDigests = {}
+        self.Expiry = ExpiryIndex()
+        self.ExtentRefs = {}
+        self.KeyExtents = {}
+        self.CurrentFiles = {}
+        self.Loaded = set()
         self.load_files()
 
+    def extent_path(self, name):
+        return f"{self.name_to_dir(name)}/{name}.kbe"
+
+    def is_external(self, f, key):
+        return f.blob_flags(key) & KBFile.FLAG_EXTERNAL
+
+    def parse_reference(self, ref):
+        # -> (extent name, size)
+        name, size = to_str(ref).split()
+        return name, int(size)
+
+    def load_extents(self, files=None, pattern=None):
+        files = self.Files.values() if files is None else files
+        for f in files:
+            for key in f.keys():
+                if self.is_external(f, key) and self.KeyMap.get(key) == f.Name:
+                    name, _ = self.parse_reference(f[key])
+                    self.ref_extent(key, name)
+        # remove extents left over by interrupted writes
+        for path in glob.glob(pattern or f"{self.RootPath}/*/*/*.kbe"):
+            name = self.path_to_name(path)
+            if name not in self.ExtentRefs and name not in self.WritingExtents:
+                os.remove(path)
+
+    def ref_extent(self, key, name):
+        self.ExtentRefs.setdefault(name, set()).add(key)
+        self.KeyExtents[key] = name
+
+    def unref_extent(self, key):
+        name = self.KeyExtents.pop(key, None)
+        if name is not None:
+            keys = self.ExtentRefs[name]
+            keys.discard(key)
+            if not keys:
+                del self.ExtentRefs[name]
+                if self.Durability == "none":
+                    self.remove_extent(name)
+                else:
+                    # the old reference may still be on disk until the next commit
+                    self.DeadExtents.add(name)
+
+    def remove_extent(self, name):
+        try:    os.remove(self.extent_path(name))
+        except FileNotFoundError:   pass
+
+    def sync_path(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:    os.fsync(fd)
+        finally:    os.close(fd)
+
+    def write_extent(self, chunks, key=None):
+        # writes the data into a new extent file without holding the lock,
+        # returns (extent name, size, content digest or None)
+        # The caller must call extent_written() once the reference to the extent is recorded or the extent is removed
+        if key is None and self.Partitions:
+            raise ValueError("Key is required for partitioned storage")
+        with self:
+            name = self.new_name(self.partition(key) if key is not None else None)
+            self.WritingExtents.add(name)           # protect from orphan removal by load_extents()
+        path = self.extent_path(name)
+        dir_path = path.rsplit("/", 1)[0]
+        h = sha256() if self.Dedup else None
+        size = 0
+        try:
+            os.makedirs(dir_path, exist_ok=True)
+            with open(path, "wb") as out:
+                for chunk in chunks:
+                    out.write(chunk)
+                    size += len(chunk)
+                    if h is not None:
+                        h.update(chunk)
+                if self.Durability != "none":
+                    # the extent must be on disk before the reference to it
+                    out.flush()
+                    os.fsync(out.fileno())
+            if self.Durability != "none":
+                self.sync_path(dir_path)
+        except:
+            self.remove_extent(name)
+            self.extent_written(name)
+            raise
+        return name, size, (h.digest() if h is not None else None)
+
+    @synchronized
+    def extent_written(self, name):
+        self.WritingExtents.discard(name)
+
+    def add_stream(self, key, stream, expires=None):
+        # stores a large blob from a file-like object or an iterable of chunks in a separate extent file
+        chunks = stream
+        if hasattr(stream, "read"):
+            chunks = iter(lambda: stream.read(self.CHUNK_SIZE), b'')
+        if key is None:
+            key = random_key()
+        name, size, digest = self.write_extent(chunks, key)
+        try:
+            key, seq = self.write_reference(key, name, size, digest, expires)
+        finally:
+            self.extent_written(name)
+        self.wait_durable(seq)
+        return key
+
+    @synchronized
+    def write_reference(self, key, name, size, digest, expires):
+        ref = ("%s %d" % (name, size)).encode("utf-8")
+        key, seq = self.write_blob(key, ref, expires, flags=KBFile.FLAG_EXTERNAL, digest=digest)
+        f = self.Files[self.KeyMap[key]]
+        actual_name = None
+        if self.is_external(f, key):
+            actual_name, _ = self.parse_reference(f[key])
+            self.ref_extent(key, actual_name)
+        if actual_name != name:
+            # deduplicated, the new extent is not needed
+            self.remove_extent(name)
+        return key, seq
+
+    def iter_blob(self, key, chunk_size=None):
+        # yields the blob data in chunks, reading large blobs from the extent file without holding the lock
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        with self:
+            key = to_bytes(key)
+            self.load_key(key)
+            if self.is_expired(key):
+                raise KeyError(key)
+            f = self.Files[self.KeyMap[key]]
+            data = f[key]
+            if not self.is_external(f, key):
+                data = [data]
+            else:
+                name, _ = self.parse_reference(data)
+                data = open(self.extent_path(name), "rb")       # stays readable if the extent is deleted
+        if isinstance(data, list):
+            yield from data
+        else:
+            with data:
+                while True:
+                    chunk = data.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    def read_extent(self, ref, chunk_size=None):
+        name, _ = self.parse_reference(ref)
+        with open(self.extent_path(name), "rb") as extent:
+            yield from iter(lambda: extent.read(chunk_size or self.CHUNK_SIZE), b'')
+
+    def scan(self, min_key=None, max_key=None, prefix=None, nworkers=4, buffer_size=8*1024*1024, expires=False):
+        #
+        # Yields (key, blob) for all live blobs, file by file in the physical order, reading several files
+        # in parallel. Blobs modified or deleted while the scan is running may or may not be included.
+        # The order of the keys is not defined.
+        # expires: if True, yields (key, blob, expiration time or None)
+        #
+        to_key = lambda k: to_bytes(k) if k is not None else None
+        args = dict(min_key=to_key(min_key), max_key=to_key(max_key), prefix=to_key(prefix), buffer_size=buffer_size)
+        files = queue.Queue()
+        with self:
+            self.load_all()
+            now = time.time()
+            live = {}           # file name -> set of keys
+            for key, name in self.KeyMap.items():
+                if not self.Expiry.is_expired(key, now):
+                    live.setdefault(name, set()).add(key)
+            for name, keys in live.items():
+                f = self.Files[name]
+                f.flush()
+                files.put((f, keys))
+        out = queue.Queue(maxsize=1000)
+        workers = [ScanWorker(self, files, out, args, expires) for _ in range(max(1, min(nworkers, len(live))))]
+        for w in workers:
+            w.start()
+        running = len(workers)
+        try:
+            while running:
+                item = out.get()
+                if item is None:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            for w in workers:
+                w.stop()            # the workers do not wait for room in the queue once stopped
+
+    def content_digest(self, blob):
+        return sha256(blob).digest()
+
+    def load_contents(self, files=None):
+        # uses the digests stored in the directory entries, reads and hashes only extents stored without one
+        for f in (self.Files.values() if files is None else files):
+            extents = {}            # (offset, size) -> [key, ...]
+            for key, (offset, size, flags) in f.Directory.items():
+                digest = f.Digests.get(key)
+                if digest is not None:
+                    self.ref_content(key, digest)
+                else:
+                    extents.setdefault((offset, size), []).append(key)
+            for (offset, size), keys in sorted(extents.items()):
+                f.F.seek(offset)
+                data = f.F.read(size)
+                if self.is_external(f, keys[0]):
+                    name, _ = self.parse_reference(data)
+                    h = sha256()
+                    with open(self.extent_path(name), "rb") as extent:
+                        for chunk in iter(lambda: extent.read(self.CHUNK_SIZE), b''):
+                            h.update(chunk)
+                    digest = h.digest()
+                else:
+                    digest = self.content_digest(data)
+                for key in keys:
+                    self.ref_content(key, digest)
+
+    def ref_content(self, key, digest):
+        self.Contents.setdefault(digest, set()).add(key)
+        self.KeyDigests[key] = digest
+
+    def unref_content(self, key):
+        digest = self.KeyDigests.pop(key, None)
+        if digest is not None:
+            keys = self.Contents[digest]
+            keys.discard(key)
+            if not keys:
+                del self.Contents[digest]
+
+    def expires(self, key):
+        # expiration time or None
+        key = to_bytes(key)
+        self.load_key(key)
+        return self.Expiry.get(key)
+
+    def content_id(self, key):
+        # content digest if known, None otherwise
+        key = to_bytes(key)
+        self.load_key(key)
+        return self.KeyDigests.get(key)
+
+    @synchronized
+    def dedup_stats(self):
+        self.load_all()
+        logical = physical = nkeys = 0
+        for f in self.Files.values():
+            extents = {}            # (offset, size) -> blob size, the extent file size for large blobs
+            for key, (offset, size, flags) in f.Directory.items():
+                blob_size = extents.get((offset, size))
+                if blob_size is None:
+                    blob_size = size
+                    if flags & KBFile.FLAG_EXTERNAL:
+                        _, blob_size = self.parse_reference(f.get_blob(key))
+                    extents[(offset, size)] = blob_size
+                logical += blob_size
+            physical += sum(extents.values())
+            nkeys += len(f.Directory)
+        return {
+            "keys":             nkeys,
+            "unique_blobs":     len(self.Contents) if self.Dedup else None,
+            "logical_bytes":    logical,
+            "physical_bytes":   physical,
+            "bytes_saved":      logical - physical,
+            "dedup_ratio":      logical/physical if physical else 1.0
+        }
+
+    @synchronized
     def keys(self):
-        return self.KeyMap.keys()
+        # expired keys are skipped
+        self.load_all()
+        now = time.time()
+        return [key for key in self.KeyMap if not self.Expiry.is_expired(key, now)]
+
+    def range_keys(self, min_key=None, max_key=None, prefix=None, after=None, limit=None):
+        # keys in sorted order, see KeyIndex.range(). Expired keys are skipped
+        self.load_all()
+        now = time.time()
+        n = 0
+        for key in self.Index.range(min_key=min_key, max_key=max_key, prefix=prefix, after=after):
+            if limit is not None and n >= limit:
+                break
+            if not self.Expiry.is_expired(key, now):
+                yield key
+                n += 1
+
+    def is_expired(self, key):
+        key = to_bytes(key)
+        self.load_key(key)
+        return self.Expiry.is_expired(key, time.time())
+
+    def expire(self, now=None, limit=None):
+        # removes expired blobs in a batch, returns number of removed blobs
+        keys, seq = self.remove_expired(now, limit)
+        self.wait_durable(seq)
+        return len(keys)
 
     @synchronized
-    def new_file(self):
-        name = random_key()
+    def remove_expired(self, now=None, limit=None):
+        # returns (list of removed keys, seq)
+        now = time.time() if now is None else now
+        by_file = {}
+        for key in self.Expiry.pop_expired(now, limit):
+            name = self.KeyMap.pop(key, None)
+            if name is None:
+                continue
+            self.Index.remove(key)
+            self.unref_content(key)
+            self.unref_extent(key)
+            if self.ChangeLog is not None:
+                self.ChangeLog.record("del", key)
+            by_file.setdefault(name, []).append(key)
+        for name, keys in by_file.items():
+            f = self.Files[name]
+            if len(keys) == len(f.Directory):
+                # everything in the file has expired
+                self.drop_file(name)
+            else:
+                f.delete_blobs(keys)
+                self.DirtyFiles.add(name)
+        if by_file:
+            self.WriteSeq += 1
+        return [key for keys in by_file.values() for key in keys], self.WriteSeq
+
+    def drop_file(self, name):
+        f = self.Files.pop(name)
+        f.PendingEntries = []
+        f.close()
+        os.remove(f.Path)
+        self.DirtyFiles.discard(name)
+        self.NewDirs.add(f.Path.rsplit("/", 1)[0])
+        partition = self.name_to_partition(name)
+        if self.CurrentFiles.get(partition) is f:
+            del self.CurrentFiles[partition]
+
+    #
+    # Bulk operations. They build new files sequentially, writing each directory once, and hold the lock
+    # for the whole operation, so they are meant to be used offline, e.g. by tools/kbs.py
+    #
+
+    def bulk_file(self, partition=None):
+        # new file for bulk loading, written under a temporary name until install_files()
+        name = self.new_name(partition)
         while name in self.Files:
-            name = random_id()
+            name = self.new_name(partition)
         path = self.name_to_path(name)
         os.makedirs(path.rsplit("/",1)[0], exist_ok=True)
+        return KBFile.create(path + ".tmp", name)
+
+    def install_files(self, files):
+        # finishes bulk loaded files, makes them durable and renames them into place
+        for f in files:
+            f.finish_bulk()
+            f.sync()
+            path = self.name_to_path(f.Name)
+            os.rename(f.Path, path)
+            f.Path = path
+            self.sync_path(path.rsplit("/",1)[0])
+            f.DeferDirectory = self.Durability != "none"
+            self.Files[f.Name] = f
+
+    def export_blobs(self, stream):
+        # writes all live blobs into the archive stream in the physical order, returns number of blobs
+        writer = ArchiveWriter(stream)
+        for key, blob, expires in self.scan(nworkers=1, expires=True):
+            writer.write(key, blob, expires)
+        writer.close()
+        return writer.Count
+
+    def import_blobs(self, stream, file_size=None):
+        # loads blobs from the archive stream, returns number of blobs
+        n, seq = self.load_blobs(ArchiveReader(stream), file_size)
+        self.wait_durable(seq)
+        return n
+
+    @synchronized
+    def load_blobs(self, items, file_size=None):
+        #
+        # Bulk loads (key, blob, expires) into new files of up to file_size bytes.
+        # Blobs with already stored content (dedup mode) are stored as aliases with write_blob()
+        # Returns (number of blobs, seq)
+        #
+        file_size = file_size or KBFile.MAX_FILE_SIZE
+        files = []
+        building = {}       # partition -> file being built
+        placed = {}         # key -> new file
+        extents = {}        # key -> extent name
+        digests = {}        # key -> content digest
+        batch_contents = {} # digest -> key
+        duplicates = {}     # key -> (blob or extent name, size, expires, digest, flags)
+        n = 0
+        for key, blob, expires in items:
+            key = to_bytes(key) if key is not None else to_bytes(random_key())
+            self.load_key(key)
+            expires = int(expires) if expires is not None else None
+            flags = 0
+            digest = None
+            n += 1
+            if self.is_large(blob):
+                view = memoryview(to_bytes(blob))
+                extent, size, digest = self.write_extent((view[i:i+self.CHUNK_SIZE] for i in range(0, len(view), self.CHUNK_SIZE)), key)
+                self.extent_written(extent)     # the lock is held until the extent is referenced or removed
+                blob = ("%s %d" % (extent, size)).encode("utf-8")
+                flags = KBFile.FLAG_EXTERNAL
+            elif self.Dedup:
+                blob = to_bytes(blob)
+                digest = self.content_digest(blob)
+            previous = duplicates.pop(key, None)
+            if previous is not None and previous[4] & KBFile.FLAG_EXTERNAL:
+                os.remove(self.extent_path(previous[0]))
+            previous = placed.pop(key, None)
+            if previous is not None:
+                del previous.Directory[key]
+                previous.Expiry.pop(key, None)
+                digests.pop(key, None)
+                if key in extents:
+                    os.remove(self.extent_path(extents.pop(key)))
+            if digest is not None and (digest in self.Contents or batch_contents.get(digest) in placed):
+                if flags & KBFile.FLAG_EXTERNAL:
+                    duplicates[key] = (extent, size, expires, digest, flags)
+                else:
+                    duplicates[key] = (blob, len(blob), expires, digest, flags)
+                continue
+            partition = self.partition(key)
+            f = building.get(partition)
+            if f is None or f.Directory and f.size + len(blob) > file_size:
+                building[partition] = f = self.bulk_file(partition)
+                files.append(f)
+            f.append_bulk(key, blob, flags, expires, digest)
+            placed[key] = f
+            if flags & KBFile.FLAG_EXTERNAL:
+                extents[key] = extent
+            if digest is not None:
+                digests[key] = digest
+                batch_contents[digest] = key
+        self.install_files(files)
+        stale = {}          # old file name -> [key, ...]
+        for f in files:
+            for key in f.keys():
+                old_name = self.KeyMap.get(key)
+                if old_name is not None:
+                    stale.setdefault(old_name, []).append(key)
+                    self.unref_extent(key)
+                    self.unref_content(key)
+                else:
+                    self.Index.add(key)
+                self.KeyMap[key] = f.Name
+                self.Expiry.add(key, f.expires(key))
+                if key in extents:
+                    self.ref_extent(key, extents[key])
+                if key in digests:
+                    self.ref_content(key, digests[key])
+                if self.ChangeLog is not None:
+                    self.ChangeLog.record("put", key)
+        for name, keys in stale.items():
+            self.Files[name].delete_blobs(keys)
+            self.DirtyFiles.add(name)
+        for key, (data, size, expires, digest, flags) in duplicates.items():
+            if flags & KBFile.FLAG_EXTERNAL:
+                self.write_reference(key, data, size, digest, expires)
+            else:
+                self.write_blob(key, data, expires, digest=digest)
+        self.WriteSeq += 1
+        return n, self.WriteSeq
+
+    @synchronized
+    def rewrite_files(self, names, file_size=None):
+        #
+        # Copies live blobs from the files into new files of up to file_size bytes and removes the old files.
+        # Returns names of the new files
+        #
+        file_size = file_size or KBFile.MAX_FILE_SIZE
+        self.commit()
+        files = []
+        building = {}       # partition -> file being built
+        for name in names:
+            src = self.Files[name]
+            partition = self.name_to_partition(name)
+            extents = {}        # (offset, size) -> [key, ...], keys sharing the data in dedup mode
+            for key, (offset, size, _) in src.Directory.items():
+                if self.KeyMap.get(key) == name:
+                    extents.setdefault((offset, size), []).append(key)
+            aliases = {keys[0]: keys[1:] for keys in extents.values()}
+            for key, blob, flags in src.scan(keys=set(aliases)):
+                f = building.get(partition)
+                if f is None or f.Directory and f.size + len(blob) > file_size:
+                    building[partition] = f = self.bulk_file(partition)
+                    files.append(f)
+                f.append_bulk(key, blob, flags, src.expires(key), src.digest(key))
+                for alias in aliases[key]:
+                    f.add_alias(alias, key, src.expires(alias))
+        self.install_files(files)
+        for f in files:
+            for key in f.keys():
+                self.KeyMap[key] = f.Name
+        for name in names:
+            self.drop_file(name)
+        for partition, f in building.items():
+            if partition not in self.CurrentFiles:
+                self.CurrentFiles[partition] = f
+        return [f.Name for f in files]
+
+    def merge_files(self, max_fill=0.5, file_size=None):
+        # combines files with live data under max_fill of file_size, returns names of the new files
+        file_size = file_size or KBFile.MAX_FILE_SIZE
+        with self:
+            self.load_all()
+            sparse = {}         # partition -> [file name, ...]
+            for name in self.Files:
+                if self.live_size(name) < max_fill * file_size:
+                    sparse.setdefault(self.name_to_partition(name), []).append(name)
+            names = [name for names in sparse.values() if len(names) > 1 for name in names]
+            return self.rewrite_files(names, file_size) if names else []
+
+    def split_files(self, file_size):
+        # breaks up files larger than file_size, returns names of the new files
+        with self:
+            self.load_all()
+            out = []
+            for name in [name for name, f in self.Files.items() if f.size > file_size]:
+                out += self.rewrite_files([name], file_size)
+            return out
+
+    def live_size(self, name):
+        # size of the data in the file referred to by the KeyMap
+        f = self.Files[name]
+        return sum(size for (offset, size) in
+                    set(f.Directory[key][:2] for key in f.keys() if self.KeyMap.get(key) == name))
+
+    @synchronized
+    def new_file(self, partition=None):
+        name = self.new_name(partition)
+        while name in self.Files:
+            name = self.new_name(partition)
+        path = self.name_to_path(name)
+        dir_path = path.rsplit("/",1)[0]
+        os.makedirs(dir_path, exist_ok=True)
         self.Files[name] = f = KBFile.create(path, name)
+        f.DeferDirectory = self.Durability != "none"
+        self.NewDirs.add(dir_path)
         return f
-    
-    @synchronized
-    def add_blob(self, key, blob):
-        if self.CurrentFile is None:
-            self.CurrentFile = self.new_file()
-        f = self.CurrentFile
-        try:
-            key = f.add_blob(key, blob)
-        except FileSizeLimitExceeded:
-            self.CurrentFile = f = self.new_file()
-            f[key] = blob
-        self.KeyMap[key] = self.CurrentFile.Name
+
+    def commit(self, seq=None):
+        #
+        # Group commit: makes changes made up to seq (default: all changes so far) durable.
+        # If another thread is already committing, waits for it and commits the remaining changes, if any
+        #
+        with self:
+            if seq is None:
+                seq = self.WriteSeq
+            while self.SyncedSeq < seq:
+                if self.Committing:
+                    self.sleep()
+                    continue
+                self.Committing = True
+                target = self.WriteSeq
+                files = [self.Files[name] for name in self.DirtyFiles if name in self.Files]
+                new_dirs = self.NewDirs
+                dead_extents = self.DeadExtents
+                self.DirtyFiles, self.NewDirs, self.DeadExtents = set(), set(), set()
+                fds = []
+                try:
+                    marks = [(f, f.PendingSeq) for f in files]
+                    for f in files:
+                        f.flush()
+                        # fsync through a duplicate, the file may be closed by drop_file() while unlocked
+                        fds.append(os.dup(f.F.fileno()))
+                    with self.unlock:
+                        for fd in fds:
+                            os.fsync(fd)                    # data first
+                    for f, mark in marks:
+                        if not f.F.closed:                  # dropped files need no directory entries
+                            f.write_pending(mark)           # then directory entries
+                            f.flush()
+                    with self.unlock:
+                        for fd in fds:
+                            os.fsync(fd)
+                        for dir_path in new_dirs:
+                            fd = os.open(dir_path, os.O_RDONLY)
+                            try:    os.fsync(fd)
+                            finally:    os.close(fd)
+                    self.SyncedSeq = max(self.SyncedSeq, target)
+                    for name in dead_extents:
+                        if name not in self.ExtentRefs:     # may have been referenced again
+                            self.remove_extent(name)
+                except:
+                    self.DirtyFiles.update(f.Name for f in files)
+                    self.NewDirs.update(new_dirs)
+                    self.DeadExtents.update(dead_extents)
+                    raise
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+                    self.Committing = False
+                    self.wakeup()
+
+    def wait_durable(self, seq):
+        # called by writers after releasing the lock
+        if self.Durability == "write":
+            self.commit(seq)
+
+    def is_large(self, blob):
+        return self.LargeBlobThreshold is not None and len(blob) > self.LargeBlobThreshold
+
+    def check_blob(self, blob, expires=None):
+        # raises ValueError if write_blob() would reject the blob
+        if expires is not None and not 0 <= int(expires) < 2**64:
+            raise ValueError("Invalid expiration time: %s" % (expires,))
+        max_size = KBFile.MAX_FILE_SIZE - KBFile.PAGE_SIZE        # header and data in a new file
+        if not self.is_large(blob) and len(to_bytes(blob)) > max_size:
+            raise ValueError("Blob is too large: %d > %d" % (len(to_bytes(blob)), max_size))
+
+    def add_blob(self, key, blob, expires=None):
+        if self.is_large(blob):
+            view = memoryview(to_bytes(blob))
+            return self.add_stream(key, (view[i:i+self.CHUNK_SIZE] for i in range(0, len(view), self.CHUNK_SIZE)), expires)
+        key, seq = self.write_blob(key, blob, expires)
+        self.wait_durable(seq)
         return key
 
+    @synchronized
+    def write_blob(self, key, blob, expires=None, flags=0, digest=None):
+        # returns (key, seq), seq is to be passed to wait_durable()
+        # digest: content digest for deduplication, if already known
+        self.check_blob(blob, expires)
+        if expires is not None:
+            expires = int(expires)          # stored with 1 second resolution
+        existing_key = None
+        if key is None and (self.Dedup or self.Partitions):
+            key = random_key()
+            while to_bytes(key) in self.KeyMap:
+                key = random_key()
+        if key is not None:
+            key = to_bytes(key)
+            self.load_key(key)
+        partition = self.partition(key) if key is not None else None
+        if self.Dedup:
+            blob = to_bytes(blob)
+            digest = digest or self.content_digest(blob)
+            self.unref_content(key)
+            # aliases must be in the same partition
+            existing_key = next((k for k in self.Contents.get(digest, ()) if self.partition(k) == partition), None)
+        if existing_key is not None:
+            f = self.Files[self.KeyMap[existing_key]]
+            key = f.add_alias(key, existing_key, expires)
+        else:
+            f = self.CurrentFiles.get(partition)
+            if f is None:
+                self.CurrentFiles[partition] = f = self.new_file(partition)
+            try:
+                key = f.add_blob(key, blob, expires, flags, digest)
+            except FileSizeLimitExceeded:
+                self.CurrentFiles[partition] = f = self.new_file(partition)
+                key = f.add_blob(key, blob, expires, flags, digest)
+        self.unref_extent(key)          # the old extent is released only once the new entry is written
+        if digest is not None:
+            self.ref_content(key, digest)
+        old_name = self.KeyMap.get(key)
+        if old_name is not None and old_name != f.Name and key in self.Files[old_name]:
+            del self.Files[old_name][key]
+            self.DirtyFiles.add(old_name)
+        self.KeyMap[key] = f.Name
+        self.Expiry.add(key, expires)
+        if old_name is None:
+            self.Index.add(key)
+        if self.ChangeLog is not None:
+            self.ChangeLog.record("put", key)
+        self.DirtyFiles.add(f.Name)
+        self.WriteSeq += 1
+        return key, self.WriteSeq
+
+    def delete_blob(self, key):
+        seq = self.remove_blob(key)
+        self.wait_durable(seq)
+
+    @synchronized
+    def remove_blob(self, key):
+        key = to_bytes(key)
+        self.load_key(key)
+        name = self.KeyMap.pop(key)
+        self.Index.remove(key)
+        self.unref_content(key)
+        self.unref_extent(key)
+        self.Expiry.remove(key)
+        del self.Files[name][key]
+        if self.ChangeLog is not None:
+            self.ChangeLog.record("del", key)
+        self.DirtyFiles.add(name)
+        self.WriteSeq += 1
+        return self.WriteSeq
+
+    __delitem__ = delete_blob
+
     def __setitem__(self, key, blob):
         assert key is not None
         return self.add_blob(key, blob)
@@ -85,8 +975,14 @@ class KBStorage(Primitive):
     def get_blob(self, key):
         if isinstance(key, str):
             key = key.encode("utf-8")
+        if self.is_expired(key):
+            raise KeyError(key)
         name = self.KeyMap[key]
         f = self.Files[name]
+        if self.is_external(f, key):
+            name, _ = self.parse_reference(f[key])
+            with open(self.extent_path(name), "rb") as extent:
+                return extent.read()
         return f[key]
         
     __getitem__ = get_blob
@@ -95,34 +991,243 @@ class KBStorage(Primitive):
     def meta(self, key):
         if isinstance(key, str):
             key = key.encode("utf-8")
+        if self.is_expired(key):
+            raise KeyError(key)
         name = self.KeyMap[key]
         f = self.Files[name]
-        return f.meta(key)
+        meta = f.meta(key)
+        if self.is_external(f, key):
+            _, meta["size"] = self.parse_reference(f[key])
+        return meta
+
+    def __contains__(self, key):
+        key = to_bytes(key)
+        self.load_key(key)
+        return key in self.KeyMap and not self.is_expired(key)
+
+class WriteBehindFlusher(PyThread):
+
+    def __init__(self, cache, interval):
+        PyThread.__init__(self, daemon=True)
+        self.Cache = cache
+        self.Interval = interval
+
+    def run(self):
+        while not self.Stop:
+            try:
+                self.Cache.flush_batch(self.Interval)
+            except Exception:
+                time.sleep(self.Interval)       # the error is reported by flush()
 
 class LRUCache(Primitive):
     
-    def __init__(self, capacity, data_source, lock=None):
+    #
+    # write_behind: if not None, maximum number of pending writes. Writes are queued and written to the storage
+    # in batches by a background thread. Pending writes are visible to readers. Writers block while the queue is full.
+    # A queued write the storage rejects is dropped and reported by the next flush() as WriteBehindError
+    #
+
+    DELETED = object()          # pending delete
+
+    def __init__(self, capacity, data_source, lock=None, write_behind=None, flush_interval=1.0, expire_interval=None):
         Primitive.__init__(self)
         self.Capacity = capacity
         self.DataSource = data_source
         self.Cache = {}
         self.CacheKeys = []
-        
+        self.Shared = {}        # content digest -> [blob, number of cached keys], for deduplicated storage
+        self.CachedDigests = {}     # key -> content digest
+        self.WriteBehind = write_behind
+        self.Pending = {}           # key -> (blob or DELETED, expires), in the order of the writes
+        self.Flushing = {}          # batch being written by the flusher
+        self.FlushError = None      # last commit error
+        self.WriteErrors = []       # [(key, exception), ...] for dropped writes, reported by flush()
+        self.Flusher = None
+        if write_behind is not None:
+            self.Flusher = WriteBehindFlusher(self, flush_interval)
+            self.Flusher.start()
+        self.ExpiryThread = None
+        if expire_interval:
+            # expire through the cache so that removed blobs are dropped from it
+            self.ExpiryThread = PeriodicThread(self.expire, expire_interval)
+            self.ExpiryThread.start()
+
+    def pending(self, key):
+        # -> (blob or DELETED, expires) or None
+        key = to_bytes(key)
+        entry = self.Pending.get(key) or self.Flushing.get(key)
+        if entry is not None:
+            blob, expires = entry
+            if blob is not self.DELETED and expires is not None and expires <= time.time():
+                entry = (self.DELETED, None)
+        return entry
+
+    def queue_write(self, key, blob, expires=None):
+        # called with the lock held
+        if key is None:
+            key = random_key()
+            while key in self.Pending or key in self.DataSource:
+                key = random_key()
+        key = to_bytes(key)
+        if len(key) > KBFile.MAX_KEY_SIZE:
+            raise ValueError("Key is too long: %d > %d" % (len(key), KBFile.MAX_KEY_SIZE))
+        check_blob = getattr(self.DataSource, "check_blob", None)
+        if check_blob is not None and blob is not self.DELETED:
+            check_blob(blob, expires)
+        while key not in self.Pending and len(self.Pending) >= self.WriteBehind:
+            if self.FlushError is not None:
+                raise self.FlushError
+            self.wakeup()           # wake up the flusher
+            self.sleep(1.0)
+        self.Pending.pop(key, None)         # keep the queue in the order of the writes
+        self.Pending[key] = (blob, expires)
+        if len(self.Pending) >= self.WriteBehind:
+            self.wakeup()
+        return key
+
+    def flush_batch(self, timeout=None):
+        # writes pending changes to the storage, returns number of written changes
+        with self:
+            if not self.Pending:
+                self.sleep(timeout)
+            if not self.Pending:
+                return 0
+            batch, self.Pending = self.Pending, {}
+            self.Flushing = batch
+            self.wakeup()           # writers waiting for room in the queue
+        seq = None
+        done = 0
+        try:
+            for key, (blob, expires) in batch.items():
+                try:
+                    if blob is self.DELETED:
+                        if key in self.DataSource:
+                            seq = self.DataSource.remove_blob(key)
+                    else:
+                        _, seq = self.DataSource.write_blob(key, blob, expires)
+                except Exception as e:
+                    # drop the write so that it does not block the queue
+                    with self:
+                        self.WriteErrors.append((key, e))
+                        if key not in self.Pending:
+                            self.uncache_key(key)
+                    continue
+                done += 1
+            if seq is not None:
+                self.DataSource.wait_durable(seq)       # group commit for the whole batch
+            self.FlushError = None
+        except Exception as e:
+            # the written changes stay in the storage and are committed by the next commit
+            self.FlushError = e
+            raise
+        finally:
+            with self:
+                self.Flushing = {}
+                self.wakeup()
+        return done
+
+    def flush(self):
+        # waits until all writes made so far are written and committed to the storage
+        if self.Flusher is not None:
+            with self:
+                while self.Pending or self.Flushing:
+                    if self.FlushError is not None:
+                        raise self.FlushError
+                    self.wakeup()
+                    self.sleep(1.0)
+                if self.WriteErrors:
+                    errors, self.WriteErrors = self.WriteErrors, []
+                    raise WriteBehindError(errors)
+        self.DataSource.commit()
+
+    def wait_flushed(self, key):
+        # called with the lock held before writing the key directly to the storage
+        self.Pending.pop(key, None)
+        while key in self.Flushing:
+            self.sleep(1.0)
+
     @synchronized
     def __getitem__(self, key):
+        key = to_bytes(key)
+        entry = self.pending(key)
+        if entry is not None:
+            if entry[0] is self.DELETED:
+                raise KeyError(key)
+            return entry[0]
+        if self.is_expired(key):
+            self.uncache_key(key)
+            raise KeyError(key)
         if key in self.Cache:
             blob = self.Cache[key]
         else:
-            blob = self.DataSource[key]
-            self.Cache[key] = blob
+            digest = self.content_id(key)
+            shared = self.Shared.get(digest) if digest is not None else None
+            blob = shared[0] if shared else self.DataSource[key]
+            if self.is_large(blob):
+                return blob
+            self.cache(key, blob, digest)
         self.bump_key_and_clean_up(key)
-        return blob
-        
-    @synchronized
-    def add_blob(self, key, blob):
-        key = self.DataSource.add_blob(key, blob)
+        return self.Cache[key]
+
+    def cache(self, key, blob, digest=None):
+        # aliases of the same content share a single copy of the blob
+        self.uncache(key)
+        if digest is not None:
+            shared = self.Shared.setdefault(digest, [blob, 0])
+            shared[1] += 1
+            blob = shared[0]
+            self.CachedDigests[key] = digest
         self.Cache[key] = blob
-        self.bump_key_and_clean_up(key)
+
+    def uncache(self, key):
+        if key in self.Cache:
+            del self.Cache[key]
+            digest = self.CachedDigests.pop(key, None)
+            if digest is not None:
+                shared = self.Shared[digest]
+                shared[1] -= 1
+                if not shared[1]:
+                    del self.Shared[digest]
+
+    def expires(self, key):
+        with self:
+            entry = self.pending(key)
+            if entry is not None:
+                return entry[1]
+        return self.DataSource.expires(key)
+
+    def content_id(self, key):
+        content_id = getattr(self.DataSource, "content_id", None)
+        return content_id(key) if content_id is not None else None
+
+    def is_expired(self, key):
+        is_expired = getattr(self.DataSource, "is_expired", None)
+        return is_expired is not None and is_expired(key)
+
+    def is_large(self, blob):
+        # large blobs are not cached
+        is_large = getattr(self.DataSource, "is_large", None)
+        return is_large is not None and is_large(blob)
+        
+    def add_blob(self, key, blob, expires=None):
+        if self.is_large(blob):
+            if key is not None:         # a new random key is not cached
+                with self:
+                    if self.Flusher is not None:
+                        self.wait_flushed(to_bytes(key))
+                    self.uncache_key(key)
+            return self.DataSource.add_blob(key, blob, expires)
+        if self.Flusher is not None:
+            with self:
+                key = self.queue_write(key, to_bytes(blob), int(expires) if expires is not None else None)
+                self.cache(key, blob)
+                self.bump_key_and_clean_up(key)
+            return key
+        with self:
+            key, seq = self.DataSource.write_blob(key, blob, expires)
+            self.cache(key, blob, self.content_id(key))
+            self.bump_key_and_clean_up(key)
+        self.DataSource.wait_durable(seq)       # do not hold the cache lock while waiting for the commit
         return key
 
     def __setitem__(self, key, blob):
@@ -135,23 +1240,131 @@ class LRUCache(Primitive):
         self.CacheKeys.insert(0, key)
         while len(self.Cache) > self.Capacity:
             k = self.CacheKeys.pop()
-            del self.Cache[k]
+            self.uncache(k)
             
+    def delete_blob(self, key):
+        if self.Flusher is not None:
+            with self:
+                entry = self.pending(key)
+                if entry is None and key not in self.DataSource or entry is not None and entry[0] is self.DELETED:
+                    raise KeyError(key)
+                self.queue_write(key, self.DELETED)
+                self.uncache_key(key)
+            return
+        with self:
+            seq = self.DataSource.remove_blob(key)
+            self.uncache_key(key)
+        self.DataSource.wait_durable(seq)
+
+    def uncache_key(self, key):
+        key = to_bytes(key)
+        if key in self.Cache:
+            self.uncache(key)
+            self.CacheKeys.remove(key)
+
+    def add_stream(self, key, stream, expires=None):
+        if key is not None:
+            with self:
+                if self.Flusher is not None:
+                    self.wait_flushed(to_bytes(key))
+                self.uncache_key(key)
+        return self.DataSource.add_stream(key, stream, expires)
+
+    def scan(self, **args):
+        # does not use the cache
+        self.flush()
+        return self.DataSource.scan(**args)
+
+    def iter_blob(self, key, chunk_size=None):
+        key = to_bytes(key)
+        with self:
+            entry = self.pending(key)
+            if entry is not None:
+                if entry[0] is self.DELETED:
+                    raise KeyError(key)
+                return iter([entry[0]])
+            if key in self.Cache and not self.is_expired(key):
+                return iter([self.Cache[key]])
+        return self.DataSource.iter_blob(key, chunk_size)
+
+    __delitem__ = delete_blob
+
     def keys(self):
+        self.flush()            # include pending writes and deletes
         return self.DataSource.keys()
         
+    def range_keys(self, **args):
+        self.flush()
+        return self.DataSource.range_keys(**args)
+
+    def __contains__(self, key):
+        with self:
+            entry = self.pending(key)
+            if entry is not None:
+                return entry[0] is not self.DELETED
+        return key in self.DataSource
+
     def meta(self, key):
+        with self:
+            entry = self.pending(key)
+            if entry is not None:
+                if entry[0] is self.DELETED:
+                    raise KeyError(key)
+                return {"size":len(entry[0]), "flags":0, "expires":entry[1]}
         return self.DataSource.meta(key)
 
     def reload(self):
+        self.flush()
         return self.DataSource.reload()
 
+    def commit(self):
+        return self.flush()
+
+    def expire(self, now=None, limit=None):
+        with self:
+            keys, seq = self.DataSource.remove_expired(now, limit)
+            for key in keys:
+                self.uncache_key(key)
+        self.DataSource.wait_durable(seq)
+        return len(keys)
+
+    def export_blobs(self, stream):
+        self.flush()
+        return self.DataSource.export_blobs(stream)
+
+    def import_blobs(self, stream, file_size=None):
+        self.flush()
+        with self:
+            n, seq = self.DataSource.load_blobs(ArchiveReader(stream), file_size)
+            # imported blobs may replace cached ones
+            self.Cache, self.CacheKeys, self.Shared, self.CachedDigests = {}, [], {}, {}
+        self.DataSource.wait_durable(seq)
+        return n
+
+    def merge_files(self, max_fill=0.5, file_size=None):
+        self.flush()
+        return self.DataSource.merge_files(max_fill, file_size)
+
+    def split_files(self, file_size):
+        self.flush()
+        return self.DataSource.split_files(file_size)
+
+    def dedup_stats(self):
+        stats = self.DataSource.dedup_stats()
+        stats["cached_keys"] = len(self.Cache)
+        stats["cached_blobs"] = len(self.Cache) - sum(n - 1 for _, n in self.Shared.values())
+        return stats
+
     def blobs(self, keys):
         uncached = []
         # send already cached blobs first so that new ones do not preempt them
         for k in keys:
-            if k in self.Cache:
-                yield k, self[k]
+            if to_bytes(k) in self.Cache:
+                try:
+                    blob = self[k]
+                except KeyError:
+                    continue        # expired
+                yield k, blob
             else:
                 uncached.append(k)
         for k in uncached:
@@ -159,13 +1372,16 @@ class LRUCache(Primitive):
                 blob = self[k]
             except KeyError:
                 continue
-            yield k, self[k]
+            yield k, blob
         
 class KBCachedStorage(LRUCache):
     
-    def __init__(self, root_path, cache_capacity=1000):
-        storage = KBStorage(root_path)
-        LRUCache.__init__(self, cache_capacity, storage)
+    def __init__(self, root_path, cache_capacity=1000, change_log=None, durability="none", sync_interval=1.0, dedup=False,
+                expire_interval=None, large_blob_threshold=None, write_behind=None, flush_interval=1.0, partitions=None):
+        storage = KBStorage(root_path, change_log=change_log, durability=durability, sync_interval=sync_interval,
+                    dedup=dedup, large_blob_threshold=large_blob_threshold, partitions=partitions)
+        LRUCache.__init__(self, cache_capacity, storage, write_behind=write_behind, flush_interval=flush_interval,
+                    expire_interval=expire_interval)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+from bisect import bisect_left, bisect_right
+
+from .util import to_bytes
+
+class KeyIndex(object):
+
+    #
+    # Sorted set of keys, stored as a list of sorted chunks.
+    # Inserts and deletes touch a single chunk, range queries cost O(log n + k).
+    #
+    #   Chunks - list of sorted lists of keys, each chunk is non-empty
+    #   Maxes  - Maxes[i] is the last (largest) key of Chunks[i]
+    #
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self, keys=()):
+        self.Chunks = []
+        self.Maxes = []
+        self.Count = 0
+        self.load(keys)
+
+    def load(self, keys):
+        keys = sorted(set(keys))
+        n = self.CHUNK_SIZE
+        self.Chunks = [keys[i:i+n] for i in range(0, len(keys), n)]
+        self.Maxes = [chunk[-1] for chunk in self.Chunks]
+        self.Count = len(keys)
+
+    def __len__(self):
+        return self.Count
+
+    def __contains__(self, key):
+        i = bisect_left(self.Maxes, key)
+        if i >= len(self.Maxes):
+            return False
+        chunk = self.Chunks[i]
+        j = bisect_left(chunk, key)
+        return j < len(chunk) and chunk[j] == key
+
+    def add(self, key):
+        if not self.Maxes:
+            self.Chunks.append([key])
+            self.Maxes.append(key)
+            self.Count += 1
+            return
+        i = bisect_left(self.Maxes, key)
+        if i >= len(self.Maxes):
+            i = len(self.Maxes) - 1
+        chunk = self.Chunks[i]
+        j = bisect_left(chunk, key)
+        if j < len(chunk) and chunk[j] == key:
+            return
+        chunk.insert(j, key)
+        self.Maxes[i] = chunk[-1]
+        self.Count += 1
+        if len(chunk) > 2*self.CHUNK_SIZE:
+            half = len(chunk)//2
+            self.Chunks[i:i+1] = [chunk[:half], chunk[half:]]
+            self.Maxes[i:i+1] = [chunk[half-1], chunk[-1]]
+
+    def remove(self, key):
+        i = bisect_left(self.Maxes, key)
+        if i >= len(self.Maxes):
+            return False
+        chunk = self.Chunks[i]
+        j = bisect_left(chunk, key)
+        if j >= len(chunk) or chunk[j] != key:
+            return False
+        del chunk[j]
+        self.Count -= 1
+        if chunk:
+            self.Maxes[i] = chunk[-1]
+        else:
+            del self.Chunks[i]
+            del self.Maxes[i]
+        return True
+
+    discard = remove
+
+    def range(self, min_key=None, max_key=None, prefix=None, after=None, limit=None):
+        #
+        # Yields keys in sorted order: min_key <= key < max_key, key > after, key starts with prefix
+        #
+        if prefix:
+            prefix = to_bytes(prefix)
+            if min_key is None or to_bytes(min_key) < prefix:
+                min_key = prefix
+        if min_key is not None:
+            min_key = to_bytes(min_key)
+        if max_key is not None:
+            max_key = to_bytes(max_key)
+        if after is not None:
+            after = to_bytes(after)
+
+        if after is not None and (min_key is None or after >= min_key):
+            start, inclusive = after, False
+        else:
+            start, inclusive = min_key, True
+
+        #
+        # Re-locate the position by the last seen key for every chunk so that
+        # the generator stays consistent if the index is modified between chunks
+        #
+        n = 0
+        while limit is None or n < limit:
+            if start is None:
+                i, j = 0, 0
+            else:
+                bisect = bisect_left if inclusive else bisect_right
+                i = bisect(self.Maxes, start)
+                if i >= len(self.Chunks):
+                    return
+                j = bisect(self.Chunks[i], start)
+            if i >= len(self.Chunks):
+                return
+            keys = self.Chunks[i][j:]
+            if limit is not None:
+                keys = keys[:limit-n]
+            for key in keys:
+                if max_key is not None and key >= max_key:
+                    return
+                if prefix and not key.startswith(prefix):
+                    return
+                yield key
+            n += len(keys)
+            start, inclusive = keys[-1], False
+
+    def __iter__(self):
+        for chunk in self.Chunks:
+            yield from chunk
@@ -0,0 +1,123 @@
+from pythreader import Primitive, PyThread, synchronized
+from collections import deque
+import time
+
+from .KBClient import KBClient
+from .util import random_key, to_bytes
+
+class ChangeLog(Primitive):
+
+    #
+    # Leader side in-memory log of changes: (seq, op, key), op is "put" or "del"
+    # Followers which fall behind the retained portion of the log or see a different epoch
+    # (leader restarted) have to re-synchronize completely
+    #
+
+    def __init__(self, capacity=100000):
+        Primitive.__init__(self)
+        self.Epoch = random_key()
+        self.Seq = 0
+        self.Entries = deque(maxlen=capacity)
+
+    @synchronized
+    def record(self, op, key):
+        self.Seq += 1
+        self.Entries.append((self.Seq, op, key))
+
+    @synchronized
+    def since(self, epoch, seq, limit=None):
+        # returns (resync, last_seq, changes)
+        if epoch != self.Epoch or seq is None or seq > self.Seq:
+            return True, self.Seq, []
+        first_seq = self.Entries[0][0] if self.Entries else self.Seq + 1
+        if seq < first_seq - 1:
+            return True, self.Seq, []
+        changes = [entry for entry in self.Entries if entry[0] > seq]
+        if limit is not None:
+            changes = changes[:limit]
+        last_seq = changes[-1][0] if changes else seq
+        return False, last_seq, changes
+
+class Follower(PyThread):
+
+    #
+    # Tails the leader's change log and applies changes to the local storage
+    #
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, leader_url, storage, interval=1.0, max_staleness=None):
+        PyThread.__init__(self, daemon=True)
+        self.LeaderURL = leader_url.rstrip("/")
+        self.Client = KBClient(self.LeaderURL)
+        self.Storage = storage
+        self.Interval = interval
+        self.MaxStaleness = max_staleness
+        self.Epoch = None
+        self.Seq = None
+        self.LastSync = None        # time of the last successful sync
+        self.LastError = None
+
+    def staleness(self):
+        return None if self.LastSync is None else time.time() - self.LastSync
+
+    def is_fresh(self):
+        staleness = self.staleness()
+        return staleness is not None and (self.MaxStaleness is None or staleness <= self.MaxStaleness)
+
+    def fetch(self, keys):
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            yield from self.Client.get_bulk(keys[i:i+self.BATCH_SIZE], expires=True)
+
+    def resync(self):
+        state = self.Client.changes(since=0)
+        epoch, seq = state["epoch"], state["seq"]
+        leader_keys = set()
+        batch = []
+        for key in self.Client.keys(page_size=self.BATCH_SIZE):
+            leader_keys.add(key)
+            batch.append(key)
+            if len(batch) >= self.BATCH_SIZE:
+                self.put(batch)
+                batch = []
+        self.put(batch)
+        for key in list(self.Storage.keys()):
+            if key not in leader_keys:
+                self.Storage.delete_blob(key)
+        # changes made during the resync will be replayed starting from seq
+        self.Epoch, self.Seq = epoch, seq
+
+    def put(self, keys):
+        for key, blob, expires in self.fetch(keys):
+            self.Storage.add_blob(key, blob, expires)
+
+    def apply(self, changes):
+        latest = {}         # key -> last op
+        for seq, op, key in changes:
+            latest[to_bytes(key)] = op
+        self.put([k for k, op in latest.items() if op == "put"])        # keys deleted by now will be skipped
+        for key, op in latest.items():
+            if op == "del" and key in self.Storage:
+                self.Storage.delete_blob(key)
+
+    def sync(self):
+        while True:
+            reply = self.Client.changes(epoch=self.Epoch, since=self.Seq, limit=self.BATCH_SIZE)
+            if reply["resync"]:
+                self.resync()
+                continue
+            changes = reply["changes"]
+            self.apply(changes)
+            self.Seq = reply["seq"]
+            if len(changes) < self.BATCH_SIZE:
+                break
+        self.LastSync = time.time()
+
+    def run(self):
+        while not self.Stop:
+            try:
+                self.sync()
+                self.LastError = None
+            except Exception as e:
+                self.LastError = e
+            time.sleep(self.Interval)
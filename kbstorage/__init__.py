@@ -1,3 +1,6 @@
 from .KBFile import KBFile
-from .KBStorage import KBStorage, KBCachedStorage 
+from .KBStorage import KBStorage, KBCachedStorage, WriteBehindError
+from .KBClient import KBClient, KBShardedClient, KBClientError
+from .Replication import ChangeLog, Follower
+from .Archive import ArchiveWriter, ArchiveReader
 from .util import to_bytes, to_str
\ No newline at end of file
@@ -1,4 +1,5 @@
 import secrets
+from hashlib import sha1
 
 def random_key(n=8):
     return secrets.token_hex(n)
@@ -6,7 +7,7 @@ def random_key(n=8):
 def key_hash(key, modulo, level=0):
     if isinstance(key, str):
         key = key.encode("utf-8")
-    h = int.from_bytes(sha1(key))
+    h = int.from_bytes(sha1(key).digest(), "big")
     return (h >> level) % modulo
     
 def to_str(x):
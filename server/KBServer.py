@@ -1,6 +1,6 @@
 from webpie import WPApp, WPHandler
-from kbstorage import KBCachedStorage, to_bytes
-import sys, re, zlib
+from kbstorage import KBCachedStorage, ChangeLog, Follower, to_bytes, to_str
+import sys, re, zlib, json, time
 from urllib.parse import unquote
 from rfc2617 import digest_server
 
@@ -27,14 +27,35 @@ class Handler(WPHandler):
         if chunk:
             yield b''.join(chunk)
 
+    def compress_stream(self, chunks):
+        compressor = zlib.compressobj()
+        for chunk in chunks:
+            out = compressor.compress(chunk)
+            if out:
+                yield out
+        yield compressor.flush()
+
     def get(self, request, relpath, key=None, compress="yes", **args):
+        if not self.App.is_fresh():
+            return "Replica is stale", 503
         key = key or relpath
         key = key.encode("utf-8")
         compress = compress == "yes"
+        db = self.App.DB
         try:
-            blob = self.App.DB[key]
+            size = db.meta(key)["size"]
+            if self.App.LargeBlobThreshold is not None and size > self.App.LargeBlobThreshold:
+                chunks = db.iter_blob(key)
+            else:
+                blob = db[key]
+                chunks = None
         except KeyError:
             return 404
+        if chunks is not None:
+            # stream large blobs
+            if compress:
+                return self.compress_stream(chunks), 200, "application/zip"
+            return chunks, 200, "application/octet-stream", {"Content-Length":size}
         content_type = "application/octet-stream"
         if compress:
             content_type = "application/zip"
@@ -43,12 +64,21 @@ class Handler(WPHandler):
         
     Realm = "kbstorage"
 
-    def put(self, request, relpath, key=None, **args):
+    def put(self, request, relpath, key=None, ttl=None, expires=None, **args):
+        if self.App.Follower is not None:
+            return "Read-only replica", 403
         ok, auth_header = digest_server(self.Realm, request.environ, self.App.get_password)
         if ok:
             key = to_bytes(key or relpath) or None
-            blob = to_bytes(request.body)
-            key = self.App.DB.add_blob(key, blob)
+            if ttl:
+                expires = time.time() + float(ttl)
+            expires = int(float(expires)) if expires else None
+            threshold = self.App.LargeBlobThreshold
+            if threshold is not None and (request.content_length or 0) > threshold:
+                key = self.App.DB.add_stream(key, request.body_file, expires)
+            else:
+                blob = to_bytes(request.body)
+                key = self.App.DB.add_blob(key, blob, expires)
             return key
         elif auth_header:
             return "Authorization required", 401, {'WWW-Authenticate': auth_header}
@@ -65,27 +95,46 @@ class Handler(WPHandler):
         self.App.DB.reload()
         return "OK"
 
-    def keys(self, request, relpath, key=None, pattern=None, min_key=None, max_key=None, **args):
-        key = key or relpath
+    def keys(self, request, relpath, key=None, pattern=None, min_key=None, max_key=None, prefix=None, 
+                after=None, limit=None, meta="no", **args):
+        #
+        # Keys are listed in sorted order. Pagination: pass the last key received as "after" to get the next page
+        #
+        if not self.App.is_fresh():
+            return "Replica is stale", 503
+        prefix = prefix or key or relpath or None
+        limit = int(limit) if limit else None
+        with_meta = meta == "yes"
         pattern_re = None
         if pattern:
             pattern_re = re.compile(unquote(pattern))
+        db = self.App.DB
         def filter_keys(keys):
+            n = 0
             for k in keys:
+                if limit is not None and n >= limit:
+                    break
                 if isinstance(k, bytes):
                     k = k.decode("utf-8")
                 if pattern_re and not pattern_re.match(k):
                     continue
-                if min_key and k < min_key:
-                    continue
-                if max_key and k >= max_key:
-                    continue
-                yield k + "\n"
-        return self.stream_as_chunks(filter_keys(self.App.DB.keys())), 200, "text/csv"
+                if with_meta:
+                    try:    size = db.meta(k)["size"]
+                    except KeyError:
+                        continue        # deleted since listed
+                    yield "%s,%d\n" % (k, size)
+                else:
+                    yield k + "\n"
+                n += 1
+        keys = db.range_keys(min_key=min_key, max_key=max_key, prefix=prefix, after=after,
+                    limit=None if pattern_re else limit)
+        return self.stream_as_chunks(filter_keys(keys)), 200, "text/csv"
     
     COMPRESS_LIMIT = 1024
     
     def get_bulk(self, request, relpath, keys=None, compress="yes", **args):
+        if not self.App.is_fresh():
+            return "Replica is stale", 503
         keys = keys or relpath
         if keys:
             keys = keys.split(",")
@@ -94,25 +143,64 @@ class Handler(WPHandler):
             keys = [k for k in keys if k]
         else:
             keys = json.load(request.body_file)
-        compress = compress == "yes"
-        
-        def stream_data(pairs):
-            def format_blob(key, blob):
-                compressed = False
-                orig_size = len(blob)
-                if compress and orig_size >= self.COMPRESS_LIMIT:
-                    compressed = True
-                    orig_size = len(blob)
-                    blob = zlib.compress(blob)
-                flags = ("z" if compressed else "-") + ","      # flags + specs delimiter
-                header = to_bytes("%s %s %d:" % (flags, key, len(blob)))
-                return header + blob
-        
-            for key, blob in pairs:
-                yield format_blob(key, blob)
-        
-        pairs = self.App.DB.blobs(keys)
-        return stream_data(pairs), 200, "application/octet-stream; charset=utf-8"
+        db = self.App.DB
+        items = ((key, blob, db.expires(key)) for key, blob in db.blobs(keys))
+        return self.stream_bulk(items, compress == "yes"), 200, "application/octet-stream; charset=utf-8"
+
+    def stream_bulk(self, items, compress):
+        # <flags>[@<expiration time>], <key> <size>:<blob> ...
+        for key, blob, expires in items:
+            compressed = False
+            if compress and len(blob) >= self.COMPRESS_LIMIT:
+                compressed = True
+                blob = zlib.compress(blob)
+            flags = "z" if compressed else "-"
+            if expires is not None:
+                flags += "@%d" % (expires,)
+            flags += ","            # flags + specs delimiter
+            header = to_bytes("%s %s %d:" % (flags, to_str(key), len(blob)))
+            yield header + blob
+
+    def scan(self, request, relpath, min_key=None, max_key=None, prefix=None, compress="yes", **args):
+        # streams all blobs in the storage physical order, the key order is not defined
+        if not self.App.is_fresh():
+            return "Replica is stale", 503
+        items = self.App.DB.scan(min_key=min_key, max_key=max_key, prefix=prefix, expires=True)
+        return self.stream_bulk(items, compress == "yes"), 200, "application/octet-stream; charset=utf-8"
+
+    def changes(self, request, relpath, epoch=None, since=None, limit=None, **args):
+        # replication log for followers
+        change_log = self.App.ChangeLog
+        if change_log is None:
+            return 404
+        since = int(since) if since is not None else None
+        limit = int(limit) if limit else None
+        resync, seq, changes = change_log.since(epoch, since, limit)
+        return {
+            "epoch":    change_log.Epoch,
+            "seq":      seq,
+            "resync":   resync,
+            "changes":  [(s, op, to_str(key)) for s, op, key in changes]
+        }
+
+    def stats(self, request, relpath, **args):
+        return {"dedup": self.App.DB.dedup_stats()}
+
+    def replication(self, request, relpath, **args):
+        status = {"role": None}
+        if self.App.ChangeLog is not None:
+            status = {"role": "leader", "epoch": self.App.ChangeLog.Epoch, "seq": self.App.ChangeLog.Seq}
+        elif self.App.Follower is not None:
+            follower = self.App.Follower
+            status = {
+                "role":         "follower",
+                "leader":       follower.LeaderURL,
+                "epoch":        follower.Epoch,
+                "seq":          follower.Seq,
+                "staleness":    follower.staleness(),
+                "last_error":   None if follower.LastError is None else str(follower.LastError)
+            }
+        return status
 
 class App(WPApp):
     
@@ -120,7 +208,26 @@ class App(WPApp):
         WPApp.__init__(self, Handler)
         self.Users = config["users"]
         storage_path = config["storage"]
-        self.DB = KBCachedStorage(storage_path)
+        replication = config.get("replication", {})
+        role = replication.get("role")
+        self.ChangeLog = self.Follower = None
+        if role == "leader":
+            self.ChangeLog = ChangeLog(replication.get("log_capacity", 100000))
+        self.LargeBlobThreshold = config.get("large_blob_threshold")
+        self.DB = KBCachedStorage(storage_path, change_log=self.ChangeLog,
+                durability=config.get("durability", "none"), sync_interval=config.get("sync_interval", 1.0),
+                dedup=config.get("dedup", False), expire_interval=config.get("expire_interval"),
+                large_blob_threshold=self.LargeBlobThreshold, write_behind=config.get("write_behind"),
+                flush_interval=config.get("flush_interval", 1.0), partitions=config.get("partitions"))
+        if role == "follower":
+            self.Follower = Follower(replication["leader"], self.DB,
+                    interval=replication.get("interval", 1.0),
+                    max_staleness=replication.get("max_staleness")
+            )
+            self.Follower.start()
+
+    def is_fresh(self):
+        return self.Follower is None or self.Follower.is_fresh()
         
     def get_password(self, realm, username):
         return self.Users.get(username)
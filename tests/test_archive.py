@@ -0,0 +1,78 @@
+import glob, io, os, subprocess, sys, time
+
+import pytest
+
+from kbstorage import KBStorage, KBFile, ArchiveWriter, ArchiveReader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_archive():
+    stream = io.BytesIO()
+    writer = ArchiveWriter(stream)
+    writer.write("a", b"1")
+    writer.write(b"b", b"", 1700000000)
+    writer.close()
+    data = stream.getvalue()
+    assert list(ArchiveReader(io.BytesIO(data))) == [(b"a", b"1", None), (b"b", b"", 1700000000)]
+    with pytest.raises(ValueError):
+        list(ArchiveReader(io.BytesIO(data[:-5])))
+    with pytest.raises(ValueError):
+        ArchiveReader(io.BytesIO(b"junk" + data[4:]))
+
+def test_export_import(tmp_path):
+    src = KBStorage(str(tmp_path / "src"), large_blob_threshold=1000, dedup=True)
+    expires = int(time.time()) + 3600
+    for i in range(50):
+        src.add_blob("k%d" % i, b"v%d" % (i % 10), expires if i % 3 == 0 else None)
+    src.add_blob("large", b"L" * 5000)
+    stream = io.BytesIO()
+    assert src.export_blobs(stream) == 51
+    dst = KBStorage(str(tmp_path / "dst"), large_blob_threshold=1000, dedup=True)
+    dst.add_blob("k1", b"old")
+    dst.add_blob("other", b"kept")
+    stream.seek(0)
+    assert dst.import_blobs(stream, file_size=300) == 51
+    for key in src.keys():
+        assert dst[key] == src[key] and dst.expires(key) == src.expires(key)
+    assert dst["other"] == b"kept"
+    assert dst.dedup_stats()["unique_blobs"] == 12
+    reopened = KBStorage(str(tmp_path / "dst"), large_blob_threshold=1000, dedup=True)
+    assert sorted(reopened.keys()) == sorted(dst.keys())
+
+def test_merge_and_split(tmp_path):
+    db = KBStorage(str(tmp_path))
+    db.load_blobs(((b"k%03d" % i, b"x" * 100, None) for i in range(100)), file_size=1000)
+    n = len(db.Files)
+    assert n > 5
+    for i in range(0, 100, 2):
+        db.delete_blob(b"k%03d" % i)
+    merged = db.merge_files(max_fill=0.9, file_size=1000)
+    assert merged and len(db.Files) < n
+    db.split_files(300)
+    assert all(f.size <= 300 for f in db.Files.values())
+    expected = sorted(b"k%03d" % i for i in range(1, 100, 2))
+    assert sorted(db.keys()) == expected
+    assert sorted(KBStorage(str(tmp_path)).keys()) == expected
+
+def kbfile(*args):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    subprocess.run([sys.executable, os.path.join(ROOT, "tools", "kbfile.py")] + list(args), env=env, check=True)
+
+@pytest.mark.parametrize("partitions", [None, 4])
+def test_kbfile_tool_resolves_large_blobs(tmp_path, partitions):
+    db = KBStorage(str(tmp_path / "db"), large_blob_threshold=1000, partitions=partitions)
+    db.add_blob("small", b"s" * 10)
+    db.add_blob("large", b"L" * 5000)
+    files = sorted(glob.glob(str(tmp_path / "db") + "/**/*.kbf", recursive=True))
+    merged = str(tmp_path / "merged.kbf")
+    kbfile("merge", merged, *files)
+    f = KBFile.open(merged)
+    assert {key: f[key] for key in f.keys()} == {b"small": b"s" * 10, b"large": b"L" * 5000}
+    assert not f.blob_flags("large") & KBFile.FLAG_EXTERNAL
+    exported = {}
+    for i, path in enumerate(files):
+        archive = str(tmp_path / ("%d.kba" % i))
+        kbfile("export", path, archive)
+        with open(archive, "rb") as stream:
+            exported.update((key, blob) for key, blob, _ in ArchiveReader(stream))
+    assert exported == {b"small": b"s" * 10, b"large": b"L" * 5000}
@@ -0,0 +1,65 @@
+import io, zlib
+
+import pytest
+
+from kbstorage.KBClient import parse_bulk, HashRing, KBShardedClient
+
+def bulk_stream(items, compress=False):
+    # same framing as KBServer.stream_bulk(): <flags>[@<expiration time>], <key> <size>:<blob>
+    out = []
+    for key, blob, expires in items:
+        flags = b"-"
+        if compress:
+            flags, blob = b"z", zlib.compress(blob)
+        if expires is not None:
+            flags += b"@%d" % expires
+        out.append(flags + b", " + key + b" %d:" % len(blob) + blob)
+    return b"".join(out)
+
+ITEMS = [
+    (b"a", b"1", None),
+    (b"key with spaces", b"", 1700000000),
+    (b"key:with:colons", b"x:y 3:" * 100, None),
+    (b"big", bytes(range(256)) * 1000, 1800000000),
+]
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64*1024])
+@pytest.mark.parametrize("compress", [False, True])
+def test_parse_bulk(chunk_size, compress):
+    data = bulk_stream(ITEMS, compress)
+    assert list(parse_bulk(io.BytesIO(data), chunk_size, expires=True)) == ITEMS
+    assert list(parse_bulk(io.BytesIO(data), chunk_size)) == [(key, blob) for key, blob, _ in ITEMS]
+
+def test_parse_bulk_truncated():
+    data = bulk_stream(ITEMS)
+    with pytest.raises(ValueError):
+        list(parse_bulk(io.BytesIO(data[:-10]), 1000))
+    with pytest.raises(ValueError):
+        list(parse_bulk(io.BytesIO(data + b"-, partial 5"), 1000))
+
+def test_hash_ring():
+    nodes = ["http://s%d" % i for i in range(4)]
+    ring = HashRing(nodes)
+    keys = ["k%d" % i for i in range(4000)]
+    owners = {key: ring.node(key) for key in keys}
+    counts = {node: list(owners.values()).count(node) for node in nodes}
+    assert min(counts.values()) > 500
+    # adding a node moves only the keys it takes over
+    bigger = HashRing(nodes + ["http://s4"])
+    moved = [key for key in keys if bigger.node(key) != owners[key]]
+    assert all(bigger.node(key) == "http://s4" for key in moved)
+    assert len(moved) < 2000
+
+def test_sharded_partition_and_merge():
+    client = KBShardedClient(["http://s%d" % i for i in range(3)])
+    try:
+        keys = ["k%d" % i for i in range(100)]
+        shards = client.partition(keys)
+        assert sorted(k for shard_keys in shards.values() for k in shard_keys) == sorted(keys)
+        assert all(client.Ring.node(k) == url for url, shard_keys in shards.items() for k in shard_keys)
+        merged = client.merge_streams([iter(range(0, 50)), iter(range(50, 100))])
+        assert sorted(merged) == list(range(100))
+        with pytest.raises(RuntimeError):
+            list(client.merge_streams([iter(range(5)), (_ for _ in ()).throw(RuntimeError("shard down"))]))
+    finally:
+        client.close()
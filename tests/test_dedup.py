@@ -0,0 +1,51 @@
+from kbstorage import KBStorage, KBCachedStorage
+
+def test_aliases(tmp_path):
+    db = KBStorage(str(tmp_path), dedup=True)
+    db.add_blob("a", b"x" * 1000)
+    db.add_blob("b", b"x" * 1000)
+    db.add_blob("c", b"y" * 1000)
+    stats = db.dedup_stats()
+    assert stats["unique_blobs"] == 2
+    assert stats["logical_bytes"] == 3000 and stats["physical_bytes"] == 2000
+    db.delete_blob("a")
+    assert db["b"] == b"x" * 1000
+    db.add_blob("b", b"z")
+    assert db.dedup_stats()["unique_blobs"] == 2
+
+def test_digests_are_stored(tmp_path, monkeypatch):
+    db = KBStorage(str(tmp_path), dedup=True, durability="write", large_blob_threshold=1000)
+    db.add_blob("a", b"x" * 100)
+    db.add_blob("b", b"x" * 100)
+    db.add_blob("large", b"L" * 5000)
+    digests = dict(db.KeyDigests)
+    hashed = []
+    original = KBStorage.content_digest
+    monkeypatch.setattr(KBStorage, "content_digest", lambda self, blob: hashed.append(blob) or original(self, blob))
+    db2 = KBStorage(str(tmp_path), dedup=True, large_blob_threshold=1000)
+    assert not hashed
+    assert db2.KeyDigests == digests
+    db2.add_blob("c", b"x" * 100)                     # deduplicated against the loaded digests
+    assert db2.dedup_stats()["unique_blobs"] == 2
+
+def test_digests_computed_for_old_files(tmp_path):
+    db = KBStorage(str(tmp_path))
+    db.add_blob("a", b"x" * 100)
+    db.add_blob("b", b"x" * 100)
+    db2 = KBStorage(str(tmp_path), dedup=True)
+    assert db2.KeyDigests[b"a"] == db2.KeyDigests[b"b"]
+
+def test_stats_for_large_blobs(tmp_path):
+    db = KBStorage(str(tmp_path), dedup=True, large_blob_threshold=1000)
+    db.add_blob("a", b"L" * 5000)
+    db.add_blob("b", b"L" * 5000)
+    stats = db.dedup_stats()
+    assert stats["logical_bytes"] == 10000 and stats["physical_bytes"] == 5000
+
+def test_cache_shares_blobs(tmp_path):
+    db = KBCachedStorage(str(tmp_path), dedup=True)
+    db["a"] = b"x" * 100
+    db["b"] = b"x" * 100
+    assert db["a"] is db["b"]
+    stats = db.dedup_stats()
+    assert stats["cached_keys"] == 2 and stats["cached_blobs"] == 1
@@ -0,0 +1,71 @@
+import threading, time
+
+import pytest
+
+from kbstorage import KBStorage
+from kbstorage.KBStorage import PeriodicThread
+
+@pytest.mark.parametrize("durability", ["none", "periodic", "write"])
+def test_reopen(tmp_path, durability):
+    db = KBStorage(str(tmp_path), durability=durability)
+    for i in range(20):
+        db.add_blob("k%d" % i, b"v%d" % i)
+    db.delete_blob("k0")
+    db.commit()
+    db2 = KBStorage(str(tmp_path))
+    assert sorted(db2.keys()) == sorted(b"k%d" % i for i in range(1, 20))
+    assert db2["k5"] == b"v5"
+
+def test_directory_entries_follow_commit(tmp_path):
+    db = KBStorage(str(tmp_path), durability="periodic", sync_interval=3600)
+    db.add_blob("a", b"1")
+    assert "a" not in KBStorage(str(tmp_path))        # directory entry is written by the commit
+    db.commit()
+    assert KBStorage(str(tmp_path))["a"] == b"1"
+
+def test_concurrent_writers(tmp_path):
+    db = KBStorage(str(tmp_path), durability="write")
+    def write(t):
+        for i in range(30):
+            db.add_blob("t%d-%d" % (t, i), b"x" * i)
+    threads = [threading.Thread(target=write, args=(t,)) for t in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert db.SyncedSeq == db.WriteSeq
+    assert len(KBStorage(str(tmp_path)).keys()) == 8*30
+
+def test_commit_while_files_are_dropped(tmp_path):
+    # expiration drops files while commits fsync them without holding the lock
+    db = KBStorage(str(tmp_path), durability="write")
+    stop = False
+    errors = []
+    def expire():
+        while not stop:
+            try:
+                db.expire()
+            except Exception as e:
+                errors.append(e)
+    thread = threading.Thread(target=expire)
+    thread.start()
+    try:
+        for i in range(300):
+            db.add_blob("k%d" % i, b"x" * 100, time.time() + 0.01)
+    finally:
+        stop = True
+        thread.join()
+    assert not errors
+
+def test_periodic_thread_survives_errors(capsys):
+    calls = []
+    def function():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("first call fails")
+    thread = PeriodicThread(function, 0.01)
+    thread.start()
+    time.sleep(0.2)
+    thread.stop()
+    assert len(calls) > 1
+    assert "first call fails" in capsys.readouterr().err
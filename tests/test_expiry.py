@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from kbstorage import KBStorage, KBCachedStorage
+from kbstorage.ExpiryIndex import ExpiryIndex
+
+def test_expiry_index():
+    index = ExpiryIndex()
+    index.add(b"a", 10)
+    index.add(b"b", 20)
+    index.add(b"c", 30)
+    index.add(b"b", 40)             # re-timed, the old heap entry is stale
+    index.remove(b"c")
+    index.add(b"d", None)
+    assert len(index) == 2 and b"d" not in index
+    assert index.is_expired(b"a", 10) and not index.is_expired(b"b", 30)
+    assert index.pop_expired(35) == [b"a"]
+    index.add(b"e", 5)
+    index.add(b"f", 6)
+    assert index.pop_expired(100, limit=2) == [b"e", b"f"]
+    assert index.pop_expired(100) == [b"b"]
+    assert len(index) == 0
+
+def test_expired_blobs_are_invisible(tmp_path):
+    db = KBStorage(str(tmp_path))
+    now = time.time()
+    db.add_blob("live", b"1")
+    db.add_blob("gone", b"2", now - 1)
+    db.add_blob("later", b"3", now + 3600)
+    with pytest.raises(KeyError):
+        db["gone"]
+    assert "gone" not in db and "later" in db
+    assert sorted(db.keys()) == [b"later", b"live"]
+    assert list(db.range_keys()) == [b"later", b"live"]
+    assert db.expires("later") == int(now + 3600)
+
+def test_expire_reclaims_space(tmp_path):
+    db = KBStorage(str(tmp_path))
+    now = time.time()
+    for i in range(10):
+        db.add_blob("k%d" % i, b"x" * 100, now - 1 if i % 2 else None)
+    assert db.expire() == 5
+    assert sorted(db.KeyMap) == sorted(b"k%d" % i for i in range(0, 10, 2))
+    db2 = KBStorage(str(tmp_path))
+    assert sorted(db2.keys()) == sorted(db.keys())
+
+def test_expiration_is_persistent(tmp_path):
+    db = KBStorage(str(tmp_path))
+    expires = int(time.time()) + 3600
+    db.add_blob("a", b"1", expires)
+    db.add_blob("a", b"2")              # overwrite without expiration
+    db.add_blob("b", b"3", expires)
+    db2 = KBStorage(str(tmp_path))
+    assert db2.expires("a") is None and db2.expires("b") == expires
+
+def test_cache_expire(tmp_path):
+    db = KBCachedStorage(str(tmp_path))
+    expires = int(time.time()) + 1        # stored with 1 second resolution
+    db.add_blob("a", b"1", expires)
+    assert db["a"] == b"1"
+    time.sleep(expires - time.time() + 0.1)
+    with pytest.raises(KeyError):
+        db["a"]
+    assert db.expire() == 1
+    assert b"a" not in db.Cache
+
+def test_write_behind_expiry(tmp_path):
+    db = KBCachedStorage(str(tmp_path), write_behind=10, flush_interval=60)
+    db.add_blob("a", b"1", time.time() - 1)
+    db.add_blob("b", b"2")
+    with pytest.raises(KeyError):
+        db["a"]
+    assert sorted(db.keys()) == [b"b"]
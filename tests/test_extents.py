@@ -0,0 +1,77 @@
+import glob, os, threading, time
+
+import pytest
+
+from kbstorage import KBStorage, KBCachedStorage, KBFile
+
+def extent_files(root):
+    return glob.glob(str(root) + "/**/*.kbe", recursive=True)
+
+def test_large_blobs(tmp_path):
+    db = KBStorage(str(tmp_path), large_blob_threshold=1000)
+    db.CHUNK_SIZE = 1000
+    blob = bytes(range(256)) * 20
+    db.add_blob("large", blob)
+    db.add_blob("small", b"s")
+    assert len(extent_files(tmp_path)) == 1
+    assert db["large"] == blob
+    assert b"".join(db.iter_blob("large")) == blob
+    assert db.meta("large")["size"] == len(blob)
+    assert KBStorage(str(tmp_path), large_blob_threshold=1000)["large"] == blob
+
+@pytest.mark.parametrize("write_behind", [None, 10])
+def test_keyless_large_blobs(tmp_path, write_behind):
+    db = KBCachedStorage(str(tmp_path), large_blob_threshold=1000, write_behind=write_behind)
+    key = db.add_blob(None, b"x" * 5000)
+    stream_key = db.add_stream(None, iter([b"y" * 3000, b"y" * 2000]))
+    assert db[key] == b"x" * 5000
+    assert db[stream_key] == b"y" * 5000
+
+def test_overwrite_removes_extent_after_commit(tmp_path):
+    db = KBStorage(str(tmp_path), durability="periodic", sync_interval=3600, large_blob_threshold=1000)
+    db.add_blob("k", b"a" * 5000)
+    db.add_blob("k", b"b" * 5000)
+    assert len(extent_files(tmp_path)) == 2       # the old reference may still be on disk
+    db.commit()
+    assert len(extent_files(tmp_path)) == 1
+    db.delete_blob("k")
+    db.commit()
+    assert extent_files(tmp_path) == []
+
+def test_failed_write_keeps_extent(tmp_path, monkeypatch):
+    db = KBStorage(str(tmp_path), durability="write", large_blob_threshold=1000)
+    db.add_blob("k", b"a" * 5000)
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(KBFile, "add_blob", fail)
+    with pytest.raises(OSError):
+        db.add_blob("k", b"small")
+    monkeypatch.undo()
+    db.commit()
+    assert db["k"] == b"a" * 5000
+
+@pytest.mark.parametrize("partitions", [None, 4])
+def test_extent_written_during_reload(tmp_path, partitions):
+    db = KBStorage(str(tmp_path), partitions=partitions)
+    started = threading.Event()
+    def chunks():
+        for i in range(5):
+            started.set()
+            time.sleep(0.05)
+            yield b"x" * 1000
+    thread = threading.Thread(target=db.add_stream, args=("k", chunks()))
+    thread.start()
+    started.wait()
+    db.reload()
+    db.load_all()                                   # partitions are loaded while the extent is written
+    thread.join()
+    assert db["k"] == b"x" * 5000
+
+def test_orphan_extents_are_removed(tmp_path):
+    db = KBStorage(str(tmp_path), large_blob_threshold=1000)
+    db.add_blob("k", b"x" * 5000)
+    orphan = os.path.dirname(extent_files(tmp_path)[0]) + "/orphan.kbe"
+    with open(orphan, "wb") as f:
+        f.write(b"orphan")
+    KBStorage(str(tmp_path), large_blob_threshold=1000)
+    assert extent_files(tmp_path) == [db.extent_path(db.KeyExtents[b"k"])]
@@ -0,0 +1,55 @@
+import random
+
+from kbstorage.KeyIndex import KeyIndex
+
+def make_index(n, chunk_size=4):
+    index = KeyIndex()
+    index.CHUNK_SIZE = chunk_size           # small chunks to exercise splits and merges
+    keys = [b"k%04d" % i for i in range(n)]
+    random.Random(0).shuffle(keys)
+    for key in keys:
+        index.add(key)
+    return index, sorted(keys)
+
+def test_add_remove():
+    index, keys = make_index(100)
+    assert len(index) == 100
+    assert list(index) == keys
+    index.add(keys[0])                      # duplicate
+    assert len(index) == 100
+    for key in keys[::2]:
+        assert index.remove(key)
+    assert not index.remove(b"missing")
+    assert list(index) == keys[1::2]
+    assert keys[1] in index and keys[0] not in index
+
+def test_range():
+    index, keys = make_index(100)
+    assert list(index.range(min_key="k0010", max_key="k0020")) == keys[10:20]
+    assert list(index.range(prefix="k005")) == keys[50:60]
+    assert list(index.range(after="k0095")) == keys[96:]
+    assert list(index.range(min_key="k0010", after="k0005", limit=3)) == keys[10:13]
+    assert list(index.range(min_key="z")) == []
+
+def test_pagination():
+    index, keys = make_index(100)
+    pages = []
+    after = None
+    while True:
+        page = list(index.range(after=after, limit=7))
+        pages += page
+        if len(page) < 7:
+            break
+        after = page[-1]
+    assert pages == keys
+
+def test_range_with_concurrent_changes():
+    index, keys = make_index(50)
+    out = []
+    for key in index.range():
+        out.append(key)
+        if key == b"k0010":
+            index.remove(b"k0020")
+            index.add(b"k0030a")
+    assert b"k0020" not in out and b"k0030a" in out
+    assert out == sorted(out)
@@ -0,0 +1,54 @@
+import glob, os
+
+import pytest
+
+from kbstorage import KBStorage
+
+def test_layout(tmp_path):
+    root = str(tmp_path / "new" / "root")
+    db = KBStorage(root, partitions=16)
+    for i in range(100):
+        db.add_blob("k%03d" % i, b"v%d" % i)
+    for path in glob.glob(root + "/*/*.kbf"):
+        partition = os.path.basename(os.path.dirname(path))
+        assert os.path.basename(path).startswith(partition + "-")
+    assert KBStorage(root).Partitions == 16
+    with pytest.raises(ValueError):
+        KBStorage(root, partitions=8)
+
+def test_existing_storage_can_not_be_partitioned(tmp_path):
+    KBStorage(str(tmp_path)).add_blob("a", b"1")
+    with pytest.raises(ValueError):
+        KBStorage(str(tmp_path), partitions=4)
+
+def test_lazy_loading(tmp_path):
+    db = KBStorage(str(tmp_path), partitions=16)
+    for i in range(100):
+        db.add_blob("k%03d" % i, b"v%d" % i)
+    db2 = KBStorage(str(tmp_path))
+    assert not db2.Loaded and not db2.Files
+    assert db2["k042"] == b"v42"
+    assert db2.Loaded == {db2.partition(b"k042")}
+    assert "missing" not in db2
+    db2.add_blob("k042", b"new")
+    assert list(db2.range_keys(limit=5)) == [b"k%03d" % i for i in range(5)]
+    assert len(db2.Loaded) == 16
+    assert KBStorage(str(tmp_path))["k042"] == b"new"
+
+def test_delete_and_expire_load_partitions(tmp_path):
+    db = KBStorage(str(tmp_path), partitions=4)
+    db.add_blob("a", b"1")
+    db.add_blob("b", b"2", 1)                   # expired
+    db2 = KBStorage(str(tmp_path))
+    db2.delete_blob("a")
+    assert db2.expire() == 1
+    assert KBStorage(str(tmp_path)).keys() == []
+
+def test_dedup_within_partitions(tmp_path):
+    db = KBStorage(str(tmp_path), partitions=4, dedup=True)
+    for i in range(20):
+        db.add_blob("k%d" % i, b"same")
+    partitions = {db.partition(b"k%d" % i) for i in range(20)}
+    assert db.dedup_stats()["physical_bytes"] == 4 * len(partitions)
+    db2 = KBStorage(str(tmp_path), dedup=True)
+    assert db2["k7"] == b"same"
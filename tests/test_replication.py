@@ -0,0 +1,103 @@
+import time
+
+from kbstorage import KBStorage, ChangeLog, Follower, to_bytes, to_str
+
+class LocalClient(object):
+
+    # leader side of the replication protocol served from a local storage, mirrors server/KBServer.py
+
+    def __init__(self, storage):
+        self.Storage = storage
+
+    def changes(self, epoch=None, since=None, limit=None):
+        resync, seq, changes = self.Storage.ChangeLog.since(epoch, since, limit)
+        return {"epoch": self.Storage.ChangeLog.Epoch, "seq": seq, "resync": resync,
+                "changes": [(s, op, to_str(key)) for s, op, key in changes]}
+
+    def keys(self, page_size=1000):
+        after = None
+        while True:
+            keys = list(self.Storage.range_keys(after=after, limit=page_size))
+            yield from keys
+            if len(keys) < page_size:
+                break
+            after = keys[-1]
+
+    def get_bulk(self, keys, expires=False):
+        for key in keys:
+            try:
+                blob = self.Storage[key]
+            except KeyError:
+                continue
+            yield (key, blob, self.Storage.expires(key)) if expires else (key, blob)
+
+def make_pair(tmp_path, capacity=100000):
+    leader = KBStorage(str(tmp_path / "leader"), change_log=ChangeLog(capacity))
+    replica = KBStorage(str(tmp_path / "replica"))
+    follower = Follower("http://leader.invalid", replica)
+    follower.Client = LocalClient(leader)
+    follower.BATCH_SIZE = 3
+    return leader, replica, follower
+
+def contents(storage):
+    return {key: storage[key] for key in storage.keys()}
+
+def test_change_log():
+    log = ChangeLog(capacity=3)
+    for i in range(5):
+        log.record("put", b"k%d" % i)
+    assert log.since(None, 0)[0]                        # unknown epoch
+    assert log.since(log.Epoch, 1)[0]                   # fell behind the retained log
+    resync, seq, changes = log.since(log.Epoch, 2, limit=2)
+    assert not resync and seq == 4 and [key for _, _, key in changes] == [b"k2", b"k3"]
+    assert log.since(log.Epoch, 5) == (False, 5, [])
+
+def test_resync(tmp_path):
+    leader, replica, follower = make_pair(tmp_path)
+    expires = int(time.time()) + 3600
+    for i in range(10):
+        leader.add_blob("k%d" % i, b"v%d" % i)
+    leader.add_blob("ttl", b"t", expires)
+    replica.add_blob("stale", b"x")
+    follower.sync()
+    assert contents(replica) == contents(leader)
+    assert replica.expires("ttl") == expires
+    assert follower.Epoch == leader.ChangeLog.Epoch and follower.is_fresh()
+
+def test_apply(tmp_path):
+    leader, replica, follower = make_pair(tmp_path)
+    leader.add_blob("a", b"1")
+    leader.add_blob("b", b"2")
+    follower.sync()
+    leader.add_blob("a", b"11")
+    leader.delete_blob("b")
+    leader.add_blob("c", b"3", int(time.time()) + 3600)
+    leader.add_blob("d", b"4")
+    leader.delete_blob("d")                             # put and delete in the same batch
+    for i in range(5):
+        leader.add_blob("n%d" % i, b"n")
+    follower.sync()
+    assert contents(replica) == contents(leader)
+    assert replica.expires("c") == leader.expires("c")
+    assert follower.Seq == leader.ChangeLog.Seq
+
+def test_resync_after_log_overflow(tmp_path):
+    leader, replica, follower = make_pair(tmp_path, capacity=2)
+    leader.add_blob("a", b"1")
+    follower.sync()
+    for i in range(5):
+        leader.add_blob("k%d" % i, b"v")
+    leader.delete_blob("a")
+    follower.sync()
+    assert contents(replica) == contents(leader)
+
+def test_resync_after_leader_restart(tmp_path):
+    leader, replica, follower = make_pair(tmp_path)
+    leader.add_blob("a", b"1")
+    follower.sync()
+    leader.ChangeLog = ChangeLog()                      # new epoch
+    leader.add_blob("b", b"2")
+    leader.delete_blob("a")
+    follower.sync()
+    assert contents(replica) == contents(leader)
+    assert follower.Epoch == leader.ChangeLog.Epoch
@@ -0,0 +1,76 @@
+import os, subprocess, sys, threading, time
+
+from kbstorage import KBStorage, KBCachedStorage
+from kbstorage.KBStorage import ScanWorker
+
+def fill(db, n=100):
+    for i in range(n):
+        db.add_blob("k%03d" % i, b"v%d" % i)
+
+def test_scan(tmp_path):
+    db = KBStorage(str(tmp_path), large_blob_threshold=1000)
+    db.load_blobs(((b"k%03d" % i, b"v%d" % i, None) for i in range(100)), file_size=200)     # several files
+    db.add_blob("large", b"L" * 5000)
+    db.add_blob("expired", b"e", time.time() - 1)
+    expected = {b"k%03d" % i: b"v%d" % i for i in range(100)}
+    expected[b"large"] = b"L" * 5000
+    assert len(db.Files) > 1
+    assert dict(db.scan(nworkers=3, buffer_size=100)) == expected
+    assert dict(db.scan(prefix="k05")) == {k: v for k, v in expected.items() if k.startswith(b"k05")}
+    assert sorted(dict(db.scan(min_key="k010", max_key="k020"))) == [b"k%03d" % i for i in range(10, 20)]
+
+def test_scan_expires(tmp_path):
+    db = KBCachedStorage(str(tmp_path), write_behind=10)
+    expires = int(time.time()) + 3600
+    db.add_blob("a", b"1", expires)
+    db.add_blob("b", b"2")              # pending writes are flushed by the scan
+    assert sorted(db.scan(expires=True)) == [(b"a", b"1", expires), (b"b", b"2", None)]
+
+def paused_scan(db, monkeypatch):
+    # starts a scan which stops before validating the first buffer it has read, returns (entered, proceed, thread, out)
+    entered, proceed = threading.Event(), threading.Event()
+    current = ScanWorker.current
+    def paused(self, f, entries):
+        entered.set()
+        proceed.wait()
+        return current(self, f, entries)
+    monkeypatch.setattr(ScanWorker, "current", paused)
+    out = []
+    thread = threading.Thread(target=lambda: out.extend(db.scan(nworkers=1, buffer_size=20000)))
+    thread.start()
+    entered.wait()
+    return proceed, thread, out
+
+def test_scan_skips_reused_space(tmp_path, monkeypatch):
+    db = KBStorage(str(tmp_path))
+    for key, c in (("k1", b"A"), ("k2", b"B"), ("k3", b"C")):
+        db.add_blob(key, c * 20000)
+    proceed, thread, out = paused_scan(db, monkeypatch)
+    db.delete_blob("k2")
+    db.add_blob("k4", b"Z" * 20000)         # reuses the space of k2
+    proceed.set()
+    thread.join()
+    assert dict(out) == {b"k1": b"A" * 20000, b"k3": b"C" * 20000}
+
+def test_scan_skips_dropped_files(tmp_path, monkeypatch):
+    db = KBStorage(str(tmp_path))
+    db.add_blob("a", b"x" * 20000, time.time() + 3600)
+    db.add_blob("b", b"y" * 20000, time.time() + 3600)
+    proceed, thread, out = paused_scan(db, monkeypatch)
+    assert db.expire(now=time.time() + 7200) == 2       # drops the file
+    proceed.set()
+    thread.join()
+    assert out == []
+
+def test_abandoned_scan_does_not_block_exit(tmp_path):
+    script = """
+import sys
+sys.path.insert(0, %r)
+from kbstorage import KBStorage
+db = KBStorage(%r)
+for i in range(3000):
+    db.add_blob("k%%d" %% i, b"x" * 100)
+items = db.scan(nworkers=2)
+next(items)
+""" % (os.path.dirname(os.path.dirname(os.path.abspath(__file__))), str(tmp_path))
+    subprocess.run([sys.executable, "-c", script], timeout=60, check=True)
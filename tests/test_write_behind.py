@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from kbstorage import KBCachedStorage, WriteBehindError
+
+def test_pending_writes(tmp_path):
+    db = KBCachedStorage(str(tmp_path), write_behind=100, flush_interval=60)
+    db["a"] = b"1"
+    db["b"] = b"2"
+    db["a"] = b"3"
+    db.delete_blob("b")
+    assert db["a"] == b"3" and "b" not in db
+    assert "a" not in db.DataSource                   # not written yet
+    with pytest.raises(KeyError):
+        db.delete_blob("b")
+    db.flush()
+    assert db.DataSource["a"] == b"3" and "b" not in db.DataSource
+
+def test_background_flush(tmp_path):
+    db = KBCachedStorage(str(tmp_path), write_behind=5, flush_interval=0.05)
+    for i in range(50):
+        db["k%d" % i] = b"v%d" % i            # blocks while the queue is full
+    deadline = time.time() + 10
+    while (db.Pending or db.Flushing) and time.time() < deadline:
+        time.sleep(0.05)
+    assert len(db.DataSource.keys()) == 50
+
+def test_invalid_writes_are_rejected(tmp_path):
+    db = KBCachedStorage(str(tmp_path), write_behind=10)
+    with pytest.raises(ValueError):
+        db.add_blob("a", b"1", expires=2**70)
+    with pytest.raises(ValueError):
+        db.add_blob("a", b"1", expires=-1)
+    assert not db.Pending
+
+def test_failed_write_is_reported(tmp_path, monkeypatch):
+    db = KBCachedStorage(str(tmp_path), write_behind=100, flush_interval=60)
+    write_blob = db.DataSource.write_blob
+    def failing(key, blob, expires=None, **args):
+        if key == b"bad":
+            raise OSError("write failed")
+        return write_blob(key, blob, expires, **args)
+    monkeypatch.setattr(db.DataSource, "write_blob", failing)
+    db["bad"] = b"1"
+    db["good"] = b"2"
+    with pytest.raises(WriteBehindError) as error:
+        db.flush()
+    assert [key for key, _ in error.value.Errors] == [b"bad"]
+    assert db.DataSource["good"] == b"2"
+    assert "bad" not in db and b"bad" not in db.Cache
+    db.flush()                                      # reported once
+
+def test_commit_error_stops_writers(tmp_path, monkeypatch):
+    db = KBCachedStorage(str(tmp_path), write_behind=2, flush_interval=0.05, durability="write")
+    write_blob = db.DataSource.write_blob
+    def slow(*args, **kwargs):
+        time.sleep(0.05)
+        return write_blob(*args, **kwargs)
+    def fail(seq):
+        raise OSError("disk gone")
+    monkeypatch.setattr(db.DataSource, "write_blob", slow)
+    monkeypatch.setattr(db.DataSource, "wait_durable", fail)
+    with pytest.raises(OSError):
+        for i in range(100):
+            db["k%d" % i] = b"v"
+
+def test_large_blobs_bypass_the_queue(tmp_path):
+    db = KBCachedStorage(str(tmp_path), write_behind=10, flush_interval=60, large_blob_threshold=1000)
+    db["k"] = b"small"
+    db["k"] = b"L" * 5000                       # must not be overwritten by the pending small write
+    db.flush()
+    assert db["k"] == b"L" * 5000 and db.DataSource["k"] == b"L" * 5000
@@ -1,5 +1,35 @@
-import sys
-from kbstorage import KBFile, to_str
+import sys, os
+from kbstorage import KBFile, ArchiveWriter, ArchiveReader, to_str
+
+def open_stream(path, mode):
+    if path == "-":
+        return sys.stdin.buffer if mode == "rb" else sys.stdout.buffer
+    return open(path, mode)
+
+def extent_path(path, ref):
+    # path of the extent file a large blob reference in the file at path refers to, see KBStorage.name_to_dir()
+    name = to_str(ref).split()[0]
+    file_dir = os.path.dirname(os.path.abspath(path))
+    if "-" in name:
+        # partitioned layout: <root>/<partition>/<name>.kbe, in the same directory as the file
+        return "%s/%s.kbe" % (file_dir, name)
+    root = os.path.dirname(os.path.dirname(file_dir))
+    return "%s/%s/%s/%s.kbe" % (root, name[-1], name[-2], name)
+
+def scan_blobs(f, keys=None):
+    # yields (key, blob, flags) in the physical order, large blobs are read from their extent files
+    # and stored in the output files as regular blobs
+    for key, blob, flags in f.scan(keys=keys):
+        if flags & KBFile.FLAG_EXTERNAL:
+            with open(extent_path(f.Path, blob), "rb") as extent:
+                blob = extent.read()
+            flags &= ~KBFile.FLAG_EXTERNAL
+        yield key, blob, flags
+
+def copy_blobs(out, f, keys=None):
+    # copies blobs in the physical order of the source file, preserving flags, expiration times and digests
+    for key, blob, flags in scan_blobs(f, keys):
+        out.append_bulk(key, blob, flags, f.expires(key), f.digest(key))
 
 command = sys.argv[1]
 args = sys.argv[2:]
@@ -19,6 +49,61 @@ elif command == "del":
     f = KBFile.open(path)
     del f[key]
     
+elif command == "export":
+    # export <file> <archive>|-
+    path, archive = args
+    f = KBFile.open(path)
+    with open_stream(archive, "wb") as stream:
+        writer = ArchiveWriter(stream)
+        for key, blob, flags in scan_blobs(f):
+            writer.write(key, blob, f.expires(key))
+        writer.close()
+
+elif command == "import":
+    # import <new file> <archive>|-
+    path, archive = args
+    out = KBFile.create(path)
+    with open_stream(archive, "rb") as stream:
+        for key, blob, expires in ArchiveReader(stream):
+            if key in out:
+                del out.Directory[key]
+            out.append_bulk(key, blob, 0, expires)
+    out.finish_bulk()
+    out.close()
+
+elif command == "merge":
+    # merge <new file> <file> ... - later files override earlier ones
+    path, inputs = args[0], args[1:]
+    files = [KBFile.open(p) for p in inputs]
+    owner = {}
+    for f in files:
+        for key in f.keys():
+            owner[key] = f
+    out = KBFile.create(path)
+    for f in files:
+        copy_blobs(out, f, set(k for k in f.keys() if owner[k] is f))
+    out.finish_bulk()
+    out.close()
+
+elif command == "split":
+    # split <file> <max size> <output prefix> - creates <output prefix>.<n>.kbf
+    path, max_size, prefix = args
+    max_size = int(max_size)
+    f = KBFile.open(path)
+    out = None
+    i = 0
+    for key, blob, flags in scan_blobs(f):
+        if out is None or out.Directory and out.size + len(blob) > max_size:
+            if out is not None:
+                out.finish_bulk()
+                out.close()
+            out = KBFile.create("%s.%d.kbf" % (prefix, i))
+            i += 1
+        out.append_bulk(key, blob, flags, f.expires(key), f.digest(key))
+    if out is not None:
+        out.finish_bulk()
+        out.close()
+
 elif command == "ls":
     path = args[0]
     f = KBFile.open(path)
@@ -7,15 +7,27 @@ if __name__ == "__main__":
     python storage.py <root> get <key>
                       <root> put <key> <file>
                       <root> ls
+                      <root> export <archive>|-
+                      [-s <file size>] <root> import <archive>|-
+                      [-f <max fill, default 0.5>] [-s <file size>] <root> merge
+                      -s <file size> <root> split
+
+        file size can use K, M, G suffixes
     """
-    
-    opts, args = getopt.getopt(sys.argv[1:], "")
-    if not args:
+
+    def parse_size(text):
+        multiplier = {"K": 1024, "M": 1024*1024, "G": 1024*1024*1024}.get(text[-1:].upper())
+        return int(text[:-1])*multiplier if multiplier else int(text)
+
+    opts, args = getopt.getopt(sys.argv[1:], "s:f:")
+    opts = dict(opts)
+    if len(args) < 2:
         print(Usage)
         sys.exit(2)
         
     root, command, args = args[0], args[1], args[2:]
     storage = KBCachedStorage(root)
+    file_size = parse_size(opts["-s"]) if "-s" in opts else None
     
     if command == "get":
         key = args[0]
@@ -32,4 +44,36 @@ if __name__ == "__main__":
             meta = storage.meta(k)
             if isinstance(k, bytes):
                 k = k.decode("utf-8")
-            print("%-40s %d" % (k, meta["size"]))
\ No newline at end of file
+            print("%-40s %d" % (k, meta["size"]))
+
+    elif command == "export":
+        path = args[0]
+        if path == "-":
+            n = storage.export_blobs(sys.stdout.buffer)
+        else:
+            with open(path, "wb") as stream:
+                n = storage.export_blobs(stream)
+        print(n, "blobs exported", file=sys.stderr)
+
+    elif command == "import":
+        path = args[0]
+        if path == "-":
+            n = storage.import_blobs(sys.stdin.buffer, file_size)
+        else:
+            with open(path, "rb") as stream:
+                n = storage.import_blobs(stream, file_size)
+        storage.commit()
+        print(n, "blobs imported", file=sys.stderr)
+
+    elif command == "merge":
+        files = storage.merge_files(float(opts.get("-f", 0.5)), file_size)
+        storage.commit()
+        print(len(files), "files created")
+
+    elif command == "split":
+        if file_size is None:
+            print(Usage)
+            sys.exit(2)
+        files = storage.split_files(file_size)
+        storage.commit()
+        print(len(files), "files created")
\ No newline at end of file